@@ -0,0 +1,93 @@
+import csv
+import glob
+import numpy as np
+import os
+
+COLUMNS = ['time', 'voxels', 'volume', 'mean', 'centroid_x', 'centroid_y', 'centroid_z']
+
+
+def series_time(filename):
+    name = os.path.basename(filename).split('.')[0]
+    series, time = name.rsplit('_', 1)
+    return series, int(time)
+
+
+def measure(preds, volumes, offsets=(0, 0, 0), voxel_volumes=1., percentiles=(10, 50, 90), threshold=0.5):
+    masks = preds[..., 0] >= threshold
+    offsets = np.broadcast_to(np.asarray(offsets, dtype=float), (masks.shape[0], 3))
+    volumes = volumes[..., 0]
+    voxels = masks.sum(axis=(1, 2, 3))
+    safe = np.maximum(voxels, 1)
+
+    inside = np.where(masks, volumes, np.nan).reshape(masks.shape[0], -1)
+    empty = voxels == 0
+    inside[empty, 0] = 0
+    pct = np.nanpercentile(inside, percentiles, axis=1)
+
+    table = {
+        'voxels': voxels,
+        'volume': voxels * np.asarray(voxel_volumes),
+        'mean': np.where(empty, np.nan, (volumes * masks).sum(axis=(1, 2, 3)) / safe),
+    }
+    for p, values in zip(percentiles, pct):
+        table['p{}'.format(p)] = np.where(empty, np.nan, values)
+    # per-axis marginals avoid materialising a coordinate grid per voxel
+    for axis, name in enumerate('xyz'):
+        other = tuple(a for a in (1, 2, 3) if a != axis + 1)
+        marginal = masks.sum(axis=other)
+        centroid = marginal.dot(np.arange(masks.shape[axis + 1])) / safe + offsets[:, axis]
+        table['centroid_' + name] = np.where(empty, np.nan, centroid)
+    return table
+
+
+class SeriesTable:
+    def __init__(self, path, suffix='_measures.csv'):
+        self.path = path
+        self.suffix = suffix
+        self.series = {}
+        for filename in glob.glob(os.path.join(path, '*' + suffix)):
+            name = os.path.basename(filename)[:-len(suffix)]
+            with open(filename) as f:
+                rows = list(csv.DictReader(f))
+            columns = {c: [] for c in (rows[0].keys() if rows else COLUMNS)}
+            for row in rows:
+                for c, v in row.items():
+                    columns[c].append(int(v) if c == 'time' else float(v))
+            self.series[name] = columns
+
+    def append(self, files, table):
+        names = set()
+        for i, filename in enumerate(files):
+            name, time = series_time(filename)
+            names.add(name)
+            columns = self.series.setdefault(name, {})
+            for c in ['time'] + sorted(k for k in table if k != 'time'):
+                columns.setdefault(c, [])
+            times = columns['time']
+            # a re-predicted time point replaces its old row
+            if time in times:
+                row = times.index(time)
+                for c in columns:
+                    del columns[c][row]
+            columns['time'].append(time)
+            for c, values in table.items():
+                columns[c].append(float(values[i]))
+        return names
+
+    def has(self, filename):
+        name, time = series_time(filename)
+        return name in self.series and time in self.series[name]['time']
+
+    def array(self, name):
+        columns = self.series[name]
+        order = np.argsort(columns['time'])
+        return {c: np.asarray(v)[order] for c, v in columns.items()}
+
+    def save(self, names=None):
+        for name in (self.series if names is None else names):
+            columns = self.array(name)
+            header = [c for c in COLUMNS if c in columns] + sorted(c for c in columns if c not in COLUMNS)
+            with open(os.path.join(self.path, name + self.suffix), 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(zip(*[columns[c] for c in header]))
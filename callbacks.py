@@ -0,0 +1,90 @@
+import logging
+import numpy as np
+import time
+from keras.callbacks import Callback, EarlyStopping
+
+
+def volume_dice(y_true, y_pred):
+    axes = tuple(range(1, y_true.ndim))
+    y_true, y_pred = y_true[..., :1], y_pred[..., :1]
+    intersection = np.sum(y_true * y_pred, axis=axes)
+    return 2. * intersection / np.maximum(np.sum(y_true, axis=axes) + np.sum(y_pred, axis=axes), 1e-7)
+
+
+class ScheduledValidation(Callback):
+    def __init__(self, generator, every=1, samples=None, streaming=False, seed=0):
+        super().__init__()
+        if samples is not None and samples < generator.n:
+            indices = np.random.RandomState(seed).choice(generator.n, samples, replace=False)
+            generator = generator.subset(np.sort(indices))
+        # batches (including any random seed slices) are drawn once and reused
+        self.batches = [generator[i] for i in range(len(generator))]
+        self.every = every
+        self.streaming = streaming
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        if (epoch + 1) % self.every:
+            return
+
+        start = time.time()
+        if self.streaming:
+            scores = [volume_dice(y, self.model.predict_on_batch(x)) for x, y in self.batches]
+            logs['val_dice_coef'] = float(np.mean(np.concatenate(scores)))
+        else:
+            totals = None
+            for x, y in self.batches:
+                values = np.array(self.model.test_on_batch(x, y), ndmin=1) * len(x)
+                totals = values if totals is None else totals + values
+            totals /= sum(len(x) for x, _ in self.batches)
+            for name, value in zip(self.model.metrics_names, totals):
+                logs['val_' + name] = float(value)
+        logging.info('validation: {:.1f}s {}'.format(time.time() - start,
+                                                      {k: v for k, v in logs.items() if k.startswith('val_')}))
+
+
+class StagedEarlyStopping(EarlyStopping):
+    """EarlyStopping across several fit calls, e.g. curriculum stages.
+
+    Keras resets the patience count and best score at every fit; here they
+    carry over. The best weights are kept and restored by `restore`.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(restore_best_weights=True, **kwargs)
+        self.started = False
+
+    def on_train_begin(self, logs=None):
+        if not self.started:
+            super().on_train_begin(logs)
+            self.started = True
+
+    def restore(self):
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+
+
+class TimeToTarget(Callback):
+    def __init__(self, target, monitor='val_dice_coef'):
+        super().__init__()
+        self.target = target
+        self.monitor = monitor
+        self.start = None
+        self.reached = None
+
+    def on_train_begin(self, logs=None):
+        # curriculum stages call fit once each; time from the first
+        if self.start is None:
+            self.start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if self.reached is None and value is not None and value >= self.target:
+            self.reached = (epoch + 1, time.time() - self.start)
+            logging.info('{} reached {} after {} epochs ({:.1f}s).'.format(self.monitor, self.target,
+                                                                           *self.reached))
+
+    def on_train_end(self, logs=None):
+        if self.reached is None:
+            logging.info('{} never reached {} ({:.1f}s).'.format(self.monitor, self.target,
+                                                                 time.time() - self.start))
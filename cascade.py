@@ -0,0 +1,107 @@
+import constants
+import numpy as np
+from data import FoldDataset, VolumeGenerator
+from process import crop, crop_offset, downsample, preprocess, roi_offset, roi_windows
+from util import read_vol
+
+
+def locate(localizer, vols, threshold=0.5):
+    # bounding box of the coarse mask in original voxel coordinates, None where nothing is found
+    coarse = np.array([downsample(vol[..., :1]) for vol in vols])
+    preds = localizer.model.predict_on_batch(coarse)
+    boxes = []
+    for vol, pred in zip(vols, preds):
+        mask = pred[..., 0] >= threshold
+        if not mask.any():
+            boxes.append(None)
+            continue
+        idx = np.argwhere(mask)
+        scale = np.array(vol.shape[:3]) / np.array(constants.COARSE_SHAPE[:3])
+        boxes.append((idx.min(axis=0) * scale, (idx.max(axis=0) + 1) * scale))
+    return boxes
+
+
+def label_offset(label):
+    idx = np.argwhere(label[..., 0] > 0)
+    if len(idx) == 0:
+        return crop_offset(label.shape)
+    return roi_offset(label.shape, (idx.min(axis=0) + idx.max(axis=0) + 1) / 2)
+
+
+def roi_dataset(input_files, label_files, groups):
+    inputs, labels = [], []
+    for input_file, label_file in zip(input_files, label_files):
+        label = read_vol(label_file)
+        offset = label_offset(label)
+        inputs.append(crop(preprocess(input_file, ['rescale']), offset))
+        labels.append(crop(label, offset))
+    return FoldDataset.from_arrays(input_files, label_files, groups, inputs, labels)
+
+
+class CascadeGenerator(VolumeGenerator):
+    """Crops every channel at a window around the organ found by `localizer`.
+
+    With `depth` (that of a fully convolutional fine model) the window is the
+    localised bounding box plus `margin`, grown to a multiple of 2 ** depth and
+    shared by the batch, so the fine stage only sees the organ. Without it the
+    window is TARGET_SHAPE, re-centred on the organ.
+    """
+    crops_per_volume = True
+
+    def __init__(self, localizer, *args, depth=None, margin=16, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.load_files:
+            raise ValueError('Cascade inference needs the full volumes, not preloaded crops.')
+        if self.prefetch:
+            raise ValueError('Cascade inference crops at offsets found per batch and cannot prefetch.')
+        self.localizer = localizer
+        self.depth = depth
+        self.margin = margin
+        self.offsets = {}
+        self.sizes = {}
+        self.decoded = {}
+        self.concat_full = None
+        if self.concat_files is not None:
+            self.concat_full = np.concatenate((preprocess(self.concat_files[0], ['rescale']),
+                                               read_vol(self.concat_files[1])), axis=-1)
+
+    def offset(self, i):
+        return self.offsets[self.index[i]]
+
+    def config(self):
+        config = super().config()
+        config['localizer'] = self.localizer.weights_hash()
+        config['window'] = None if self.depth is None else [self.depth, self.margin]
+        return config
+
+    def _windows(self, shapes, boxes):
+        if self.depth is None:
+            return [(crop_offset(shape) if box is None else roi_offset(shape, (box[0] + box[1]) / 2), None)
+                    for shape, box in zip(shapes, boxes)]
+        multiple = 2 ** self.depth
+        bounds = []
+        for shape, box in zip(shapes, boxes):
+            if box is None:
+                # nothing found: the centre crop
+                lo = np.array(crop_offset(shape))
+                bounds.append((lo, lo + np.array(constants.TARGET_SHAPE[:3])))
+            else:
+                bounds.append((np.floor(box[0]).astype(int) - self.margin, np.ceil(box[1]).astype(int) + self.margin))
+        return roi_windows(shapes, bounds, multiple)
+
+    def _context(self, row):
+        return crop(self.concat_full, self.offsets[row], self.sizes[row])
+
+    def _load(self, items, row, funcs):
+        vol = self.decoded[row] if items is self.inputs else read_vol(items[row])
+        return crop(vol, self.offsets[row], self.sizes[row])
+
+    def __getitem__(self, idx):
+        rows = self._rows(idx)
+        # decode each input once, locate the organ, then crop every channel at the same ROI
+        self.decoded = {row: preprocess(self.inputs[row], [f for f in self.funcs if f != 'resize']) for row in rows}
+        vols = [self.decoded[row] for row in rows]
+        windows = self._windows([vol.shape for vol in vols], locate(self.localizer, vols))
+        for row, (offset, size) in zip(rows, windows):
+            self.offsets[row], self.sizes[row] = offset, size
+        return super().__getitem__(idx)
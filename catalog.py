@@ -0,0 +1,126 @@
+import fnmatch
+import glob
+import json
+import logging
+import os
+from util import atomic_write_json
+
+SUFFIX = '.nii.gz'
+
+
+def parse(filename):
+    # {sample}_{time}[_{organ}].nii.gz; None for anything else
+    name = os.path.basename(filename)
+    if not name.endswith(SUFFIX):
+        return None
+    parts = name[:-len(SUFFIX)].split('_', 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else None
+
+
+def _order(filename):
+    # (sample, time) order, numeric in time; other names sort by themselves
+    return (parse(filename) or (filename, 0))[:2] + (filename,)
+
+
+def _match(parts, patterns):
+    return len(parts) == len(patterns) and all(fnmatch.fnmatchcase(p, q) for p, q in zip(parts, patterns))
+
+
+class Catalog:
+    """Index of {root}/{kind}/{sample}/{sample}_{time}[_{organ}].nii.gz.
+
+    The tree is listed once and cached in {root}/.catalog.json; later loads only
+    re-list sample directories whose modification time changed. Every name in a
+    sample directory is kept so globs there match what glob.glob would.
+    """
+
+    def __init__(self, root='data', filename='.catalog.json'):
+        self.root = root
+        self.filename = os.path.join(root, filename)
+        self.dirs = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.dirs = json.load(f)
+        self.scan()
+
+    def scan(self):
+        dirs = {}
+        changed = 0
+        for kind in sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []:
+            if not os.path.isdir(os.path.join(self.root, kind)):
+                continue
+            for sample in sorted(os.listdir(os.path.join(self.root, kind))):
+                path = os.path.join(self.root, kind, sample)
+                if not os.path.isdir(path):
+                    continue
+                key = kind + '/' + sample
+                mtime = os.path.getmtime(path)
+                cached = self.dirs.get(key)
+                if cached is not None and cached['mtime'] == mtime and 'names' in cached:
+                    dirs[key] = cached
+                else:
+                    names = sorted(f for f in os.listdir(path) if not f.startswith('.'))
+                    dirs[key] = {'mtime': mtime, 'names': names}
+                    changed += 1
+        if changed or len(dirs) != len(self.dirs):
+            logging.info('Catalog: re-listed {} of {} directories.'.format(changed, len(dirs)))
+            self.dirs = dirs
+            self.save()
+
+        self.entries = {}
+        for key, value in self.dirs.items():
+            kind = key.split('/')[0]
+            for name in filter(parse, value['names']):
+                self.entries[(kind,) + parse(name)] = os.path.normpath(os.path.join(self.root, key, name))
+        self.order = sorted(self.entries, key=lambda k: (k[0], k[1], k[2], k[3] or ''))
+
+    def save(self):
+        atomic_write_json(self.dirs, self.filename)
+
+    def find(self, kind, sample, time, organ=None):
+        return self.entries.get((kind, sample, time, organ))
+
+    def key(self, filename):
+        parsed = parse(filename)
+        if parsed is None:
+            raise ValueError('{} is not named {{sample}}_{{time}}[_{{organ}}]{}.'.format(filename, SUFFIX))
+        return parsed
+
+    def inside(self, pattern):
+        return not os.path.relpath(pattern, self.root).startswith(os.pardir)
+
+    def kind(self, pattern):
+        return os.path.relpath(pattern, self.root).split(os.sep)[0]
+
+    def glob(self, pattern):
+        # {kind}/{sample}/{name} patterns are answered from the index, anything else from disk
+        rel = os.path.relpath(pattern, self.root).split(os.sep)
+        if not self.inside(pattern) or len(rel) != 3 or any(p.startswith('.') for p in rel):
+            return sorted(glob.glob(pattern), key=_order)
+        # matched per path component, so * never crosses a directory like glob's
+        parts = os.path.abspath(pattern).split(os.sep)
+        found = [os.path.normpath(os.path.join(self.root, key, name)) for key, value in self.dirs.items()
+                 for name in value['names']]
+        return sorted((f for f in found if _match(os.path.abspath(f).split(os.sep), parts)), key=_order)
+
+    def partner(self, filename, kind, organ=None):
+        sample, time, _ = self.key(filename)
+        found = self.find(kind, sample, time, organ)
+        if found is None:
+            raise ValueError('No {} volume for {}.'.format(kind, filename))
+        return found
+
+    def check_pairs(self, files, others):
+        if len(files) != len(others):
+            raise ValueError('{} volumes but {} to pair them with.'.format(len(files), len(others)))
+        for f, g in zip(files, others):
+            if self.key(f)[:2] != self.key(g)[:2]:
+                raise ValueError('{} and {} are not the same time point.'.format(f, g))
+
+    def pairs(self, organ, kind='labels', input_kind='raw'):
+        labels = [self.entries[k] for k in self.order if k[0] == kind and k[3] == organ]
+        inputs = [self.partner(f, input_kind) for f in labels]
+        samples = [self.key(f)[0] for f in labels]
+        return inputs, labels, samples
@@ -0,0 +1,109 @@
+import logging
+import numpy as np
+import tensorflow as tf
+import time
+import util
+from keras import backend as K
+from models import BaseModel, evaluate
+
+
+def prune_weights(model, sparsity):
+    # zero the smallest-magnitude kernel weights of every convolution, per layer; the kernels stay dense,
+    # so this only shrinks compressed files and does not speed up inference
+    for layer in model.layers:
+        if hasattr(layer, 'kernel_size'):
+            weights = layer.get_weights()
+            if not weights:
+                continue
+            kernel = weights[0]
+            threshold = np.percentile(np.abs(kernel), sparsity * 100)
+            weights[0] = np.where(np.abs(kernel) < threshold, 0, kernel).astype(kernel.dtype)
+            layer.set_weights(weights)
+
+
+def to_tflite(model, calibration=None):
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), [model.input], [model.output])
+    # Conv3D has no int8 builtin on every TFLite version, so unsupported ops fall back to TF kernels
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if calibration is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([x[np.newaxis].astype(np.float32)] for x in calibration)
+    return converter.convert()
+
+
+def export(model, filename, sparsity=None, calibration=None):
+    weights = model.model.get_weights()
+    if sparsity:
+        prune_weights(model.model, sparsity)
+
+    if filename.endswith('.tflite'):
+        with open(filename, 'wb') as f:
+            f.write(to_tflite(model.model, calibration))
+    else:
+        model.model.save(filename)
+
+    model.model.set_weights(weights)
+
+
+class TFLiteRunner:
+    def __init__(self, filename):
+        self.interpreter = tf.lite.Interpreter(model_path=filename)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        # no loss without the training weights; the metrics match BaseModel's
+        self.metrics_names = ['acc', 'dice_coef']
+
+    def predict_on_batch(self, x):
+        # the converted graph has a fixed batch size of one
+        preds = []
+        for vol in x:
+            self.interpreter.set_tensor(self.input['index'], vol[np.newaxis].astype(self.input['dtype']))
+            self.interpreter.invoke()
+            preds.append(self.interpreter.get_tensor(self.output['index'])[0])
+        return np.array(preds)
+
+
+class QuantizedModel(BaseModel):
+    def __init__(self, filename, name=None):
+        self.filename = filename
+        self.model = TFLiteRunner(filename)
+        self.input_size = tuple(self.model.input['shape'][1:])
+        self.name = name if name else 'quantized'
+
+    def weights_hash(self):
+        return util.file_hash(self.filename)
+
+    def save(self):
+        raise TypeError('Quantized models are exported with compress.export.')
+
+    def test(self, generator):
+        return evaluate(self.model.predict_on_batch, generator)
+
+
+def dice(y_true, y_pred, threshold=0.5):
+    axes = tuple(range(1, y_true.ndim))
+    y_pred = y_pred >= threshold
+    y_true = y_true >= threshold
+    intersection = np.sum(y_true & y_pred, axis=axes)
+    total = np.sum(y_true, axis=axes) + np.sum(y_pred, axis=axes)
+    return 2. * intersection / np.maximum(total, 1)
+
+
+def compare(reference, candidate, generator):
+    results = {'reference': [], 'candidate': []}
+    times = {'reference': 0., 'candidate': 0.}
+    for idx in range(len(generator)):
+        x, y = generator[idx]
+        for key, model in (('reference', reference), ('candidate', candidate)):
+            start = time.time()
+            preds = model.model.predict_on_batch(x)
+            times[key] += time.time() - start
+            results[key].extend(dice(y, preds))
+
+    stats = {key: float(np.mean(values)) for key, values in results.items()}
+    stats['difference'] = stats['candidate'] - stats['reference']
+    stats['speedup'] = times['reference'] / max(times['candidate'], 1e-9)
+    logging.info('dice {reference:.4f} -> {candidate:.4f} ({difference:+.4f}), '
+                 'speedup {speedup:.2f}x'.format(**stats))
+    return stats
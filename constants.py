@@ -1,2 +1,3 @@
 TARGET_SHAPE = (96, 96, 64, 1)
+COARSE_SHAPE = (48, 48, 32, 1)
 MAX_VALUE = 1500.
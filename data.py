@@ -1,8 +1,82 @@
+import constants
+import copy
+import multiprocessing
 import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from image3d import ImageTransformer, VolumeIterator
+from keras import backend as K
 from keras.utils.data_utils import Sequence
-from process import preprocess
-from util import shape
+from process import downsample, preprocess
+from util import file_hash, shape
+
+
+def add_seeds(batch, labels, seed_type):
+    new_batch = np.zeros(batch.shape[:-1] + (batch.shape[-1] + 1,), dtype=batch.dtype)
+    new_batch[..., :-1] = batch
+    for i, label in enumerate(labels):
+        # extra label channels (e.g. distillation targets) never seed
+        label = label[..., :1]
+        if seed_type == 'slice':
+            r = np.random.choice(label.shape[0])
+            while not np.any(label[r]):
+                r = np.random.choice(label.shape[0])
+            new_batch[i, r, ..., -1:] = label[r]
+        elif seed_type == 'volume':
+            new_batch[i, ..., -1:] = label
+    return new_batch
+
+
+def load_context(concat_files):
+    # reference volume and its label; kept once and appended to every input at batch time
+    return np.concatenate((preprocess(concat_files[0]),
+                           preprocess(concat_files[1], funcs=['resize'])), axis=-1).astype(K.floatx())
+
+
+class FoldDataset:
+    def __init__(self, input_files, label_files, groups):
+        self.input_files = list(input_files)
+        self.label_files = list(label_files)
+        self.groups = np.asarray(groups)
+        # stored in the Keras float type so generator views never convert (copy) them
+        self.inputs = np.array([preprocess(file) for file in input_files], dtype=K.floatx())
+        self.labels = np.array([preprocess(file, funcs=['resize']) for file in label_files], dtype=K.floatx())
+        self.resampled = {}
+
+    @classmethod
+    def from_arrays(cls, input_files, label_files, groups, inputs, labels):
+        dataset = cls.__new__(cls)
+        dataset.input_files = list(input_files)
+        dataset.label_files = list(label_files)
+        dataset.groups = np.asarray(groups)
+        dataset.inputs = np.asarray(inputs, dtype=K.floatx())
+        dataset.labels = np.asarray(labels, dtype=K.floatx())
+        dataset.resampled = {}
+        return dataset
+
+    def __len__(self):
+        return len(self.input_files)
+
+    def group(self, group):
+        return np.flatnonzero(self.groups == group)
+
+    def fold(self, group):
+        return np.flatnonzero(self.groups != group), self.group(group)
+
+    def resample(self, factor):
+        # computed once per factor; labels are re-binarised after interpolation
+        if factor == 1:
+            return self
+        if factor not in self.resampled:
+            size = tuple(s // factor for s in self.inputs.shape[1:4])
+            inputs = [downsample(vol, size + vol.shape[3:]) for vol in self.inputs]
+            labels = [downsample(vol, size + vol.shape[3:]) >= 0.5 for vol in self.labels]
+            self.resampled[factor] = FoldDataset.from_arrays(self.input_files, self.label_files, self.groups,
+                                                             inputs, labels)
+        return self.resampled[factor]
 
 
 class AugmentGenerator(VolumeIterator):
@@ -18,23 +92,24 @@ class AugmentGenerator(VolumeIterator):
                  zoom_range=0.1,
                  fill_mode='nearest',
                  cval=0.,
-                 flip=True):
-        self.inputs = np.array([preprocess(file) for file in input_files])
-
-        if label_files is not None:
-            self.labels = np.array([preprocess(file, funcs=['resize']) for file in label_files])
+                 flip=True,
+                 dataset=None,
+                 index=None,
+                 funcs=('rescale', 'resize'),
+                 context=None):
+        if dataset is not None:
+            self.inputs = dataset.inputs
+            self.labels = dataset.labels
         else:
-            self.labels = None
+            self.inputs = np.array([preprocess(file, funcs) for file in input_files])
+            if label_files is not None:
+                label_funcs = [f for f in funcs if f != 'rescale']
+                self.labels = np.array([preprocess(file, funcs=label_funcs) for file in label_files])
+            else:
+                self.labels = None
 
         self.seed_type = seed_type
-
-        if concat_files is not None:
-            concat = np.concatenate((preprocess(concat_files[0]),
-                                     preprocess(concat_files[1], funcs=['resize'])), axis=-1)
-            new_inputs = []
-            for vol in self.inputs:
-                new_inputs.append(np.concatenate((vol, concat), axis=-1))
-            self.inputs = np.array(new_inputs)
+        self.concat = context if concat_files is None else load_context(concat_files)
 
         image_transformer = ImageTransformer(rotation_range=rotation_range,
                                              shift_range=shift_range,
@@ -44,7 +119,8 @@ class AugmentGenerator(VolumeIterator):
                                              cval=cval,
                                              flip=flip)
 
-        super().__init__(self.inputs, self.labels, image_transformer, batch_size=batch_size)
+        super().__init__(self.inputs, self.labels, image_transformer, batch_size=batch_size, index=index,
+                         context=self.concat)
 
     def _get_batches_of_transformed_samples(self, index_array):
         batch = super()._get_batches_of_transformed_samples(index_array)
@@ -53,24 +129,19 @@ class AugmentGenerator(VolumeIterator):
             if self.labels is None:
                 raise ValueError('No labels to generate slices.')
             batch_x, batch_y = batch
-            
-            new_batch_x = np.zeros(tuple(list(batch_x.shape[:-1]) + [batch_x.shape[-1] + 1]))
-            for i, label in enumerate(batch_y):
-                if self.seed_type == 'slice':
-                    seed = np.zeros(batch_x[i].shape)
-                    r = np.random.choice(label.shape[0])
-                    while not np.any(label[r]):
-                        r = np.random.choice(label.shape[0])
-                    seed[r] = label[r]
-                elif self.seed_type == 'volume':
-                    seed = label.copy()
-                new_batch_x[i] = np.concatenate((batch_x[i], seed), axis=-1)
-            batch = (new_batch_x, batch_y)
+            batch = (add_seeds(batch_x, batch_y, self.seed_type), batch_y)
 
         return batch
 
+    def add_targets(self, targets):
+        self.labels = np.concatenate((self.labels, targets), axis=-1)
+        self.y = np.asarray(self.labels, dtype=self.y.dtype)
+
 
 class VolumeGenerator(Sequence):
+    # whether offset() and the window size change from volume to volume
+    crops_per_volume = False
+
     def __init__(self,
                  input_files,
                  seed_files=None,
@@ -80,57 +151,172 @@ class VolumeGenerator(Sequence):
                  concat_files=None,
                  load_files=False,
                  include_labels=False,
-                 rescale=True):
+                 rescale=True,
+                 dataset=None,
+                 index=None,
+                 funcs=None,
+                 prefetch=0,
+                 memory_cap=None):
+        self.files = input_files
+        self.seed_files = seed_files
+        self.label_files = label_files
         self.inputs = input_files
         self.seeds = seed_files
         self.labels = label_files
         self.batch_size = batch_size
         self.seed_type = seed_type
         self.concat = None
+        self.concat_files = concat_files
         self.load_files = load_files
         self.include_labels = include_labels
-        self.funcs = ['rescale', 'resize'] if rescale else ['resize']
+        if funcs is None:
+            funcs = ['rescale', 'resize'] if rescale else ['resize']
+        self.funcs = list(funcs)
+        self.label_funcs = [f for f in self.funcs if f != 'rescale']
         self.shape = shape(input_files[0])
-        self.n = len(input_files)
+        self.index = np.arange(len(input_files)) if index is None else np.asarray(index)
+        self.n = len(self.index)
         self.idx = 0
-        
+        # batches decoded ahead by a thread pool when reading from disk; memory_cap is in bytes
+        self.prefetch = prefetch
+        self.memory_cap = memory_cap
+        self._reset_prefetch()
+
         if concat_files is not None:
-            self.concat = np.concatenate((preprocess(concat_files[0]),
-                                          preprocess(concat_files[1], funcs=['resize'])), axis=-1)
+            self.concat = load_context(concat_files)
 
-        if load_files:
+        if dataset is not None:
+            self.inputs = dataset.inputs
+            self.labels = dataset.labels
+            self.load_files = True
+        elif load_files:
             self.inputs = np.array([preprocess(file, self.funcs) for file in input_files])
-            if self.concat is not None:
-                new_inputs = []
-                for vol in self.inputs:
-                    new_inputs.append(np.concatenate((vol, self.concat), axis=-1))
-                self.inputs = np.array(new_inputs)
             if seed_files is not None:
-                self.seeds = np.array([preprocess(file, ['resize']) for file in seed_files])
+                self.seeds = np.array([preprocess(file, self.label_funcs) for file in seed_files])
             if label_files is not None:
-                self.labels = np.array([preprocess(file, ['resize']) for file in label_files])
+                self.labels = np.array([preprocess(file, self.label_funcs) for file in label_files])
 
     def __len__(self):
         return (self.n + self.batch_size - 1) // self.batch_size
 
+    def file(self, i):
+        return self.files[self.index[i]]
+
+    def offset(self, i):
+        # where the network input sits in the original volume; None is the centre crop
+        return None
+
+    def sources(self, i):
+        j = self.index[i]
+        files = [self.files[j]]
+        if self.seed_files is not None:
+            files.append(self.seed_files[j])
+        if self.seed_type is not None and self.label_files is not None:
+            files.append(self.label_files[j])
+        return files
+
+    def config(self):
+        return {
+            'funcs': self.funcs,
+            'seed_type': self.seed_type,
+            'concat': None if self.concat_files is None else [file_hash(f) for f in self.concat_files],
+            'target_shape': list(constants.TARGET_SHAPE),
+            'max_value': constants.MAX_VALUE,
+        }
+
+    def subset(self, indices):
+        gen = copy.copy(self)
+        gen.index = self.index[np.asarray(indices, dtype=int)]
+        gen.n = len(gen.index)
+        gen.idx = 0
+        gen._reset_prefetch()
+        return gen
+
+    def _reset_prefetch(self):
+        self._pool = None
+        self._pending = {}
+        self._batch_bytes = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        for futures in self._pending.values():
+            for fs in futures.values():
+                for f in fs:
+                    f.cancel()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._reset_prefetch()
+
+    def _rows(self, idx):
+        return self.index[self.batch_size * idx:self.batch_size * (idx + 1)]
+
+    def _context(self, row):
+        return self.concat
+
+    def _load(self, items, row, funcs):
+        return items[row] if self.load_files else preprocess(items[row], funcs)
+
+    def _jobs(self):
+        # every file of the batch once; labels serve both seeding and include_labels
+        jobs = {'inputs': (self.inputs, self.funcs)}
+        if self.seeds is not None:
+            jobs['seeds'] = (self.seeds, self.label_funcs)
+        if self.labels is not None and (self.seed_type is not None or self.include_labels):
+            jobs['labels'] = (self.labels, self.label_funcs)
+        return jobs
+
+    def _decode(self, rows, submit):
+        return {key: [submit(self._load, items, row, funcs) for row in rows]
+                for key, (items, funcs) in self._jobs().items()}
+
+    def _estimate_bytes(self, rows):
+        # an upper bound from the headers (before cropping), until a decoded batch has been measured
+        itemsize = np.dtype(K.floatx()).itemsize
+        return sum(int(np.prod(shape(items[row]))) * itemsize for items, _ in self._jobs().values() for row in rows)
+
+    def _prefetched(self, idx):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max(1, min(self.prefetch * self.batch_size,
+                                                           multiprocessing.cpu_count())))
+            if self.memory_cap is not None and self._batch_bytes is None:
+                self._batch_bytes = self._estimate_bytes(self._rows(idx))
+            futures = self._pending.pop(idx, None)
+            if futures is None:
+                futures = self._decode(self._rows(idx), self._pool.submit)
+            # anything outside the window was a jump in access order
+            for j in [j for j in self._pending if not idx < j <= idx + self.prefetch]:
+                for fs in self._pending.pop(j).values():
+                    for f in fs:
+                        f.cancel()
+            for j in range(idx + 1, min(idx + 1 + self.prefetch, len(self))):
+                if j in self._pending:
+                    continue
+                if self.memory_cap is not None and (len(self._pending) + 2) * self._batch_bytes > self.memory_cap:
+                    break
+                self._pending[j] = self._decode(self._rows(j), self._pool.submit)
+        decoded = {key: [f.result() for f in fs] for key, fs in futures.items()}
+        self._batch_bytes = sum(v.nbytes for vs in decoded.values() for v in vs)
+        return decoded
+
     def __getitem__(self, idx):
-        batch = []
-        for file in self.inputs[self.batch_size * idx:self.batch_size * (idx + 1)]:
-            if self.load_files:
-                volume = file
-            elif self.concat is None:
-                volume = preprocess(file, self.funcs)
-            else:
-                volume = np.concatenate((preprocess(file, self.funcs), self.concat), axis=-1)
-            batch.append(volume)
-        batch = np.array(batch)
+        rows = self._rows(idx)
+        if self.prefetch and not self.load_files:
+            decoded = self._prefetched(idx)
+        else:
+            decoded = self._decode(rows, lambda f, *args: f(*args))
+
+        batch = None
+        for i, (row, volume) in enumerate(zip(rows, decoded['inputs'])):
+            if batch is None:
+                channels = volume.shape[-1] + (0 if self.concat is None else self.concat.shape[-1])
+                batch = np.empty((len(rows),) + volume.shape[:-1] + (channels,), dtype=K.floatx())
+            batch[i, ..., :volume.shape[-1]] = volume
+            if self.concat is not None:
+                batch[i, ..., volume.shape[-1]:] = self._context(row)
 
         if self.seeds is not None:
-            seeds = []
-            for file in self.seeds[self.batch_size * idx:self.batch_size * (idx + 1)]:
-                seed = file if self.load_files else preprocess(file, ['resize'])
-                seeds.append(seed)
-            batch = np.concatenate((batch, np.array(seeds)), axis=-1)
+            batch = np.concatenate((batch, np.array(decoded['seeds'])), axis=-1)
 
         if self.seed_type is not None:
             if self.labels is None:
@@ -138,30 +324,13 @@ class VolumeGenerator(Sequence):
             if self.seeds is not None:
                 raise ValueError('Seeds already exist.')
 
-            new_batch = np.zeros(tuple(list(batch.shape[:-1]) + [batch.shape[-1] + 1]))
-            for i, file in enumerate(self.labels[self.batch_size * idx:self.batch_size * (idx + 1)]):
-                label = file if self.load_files else preprocess(file, ['resize'])
-                if self.seed_type == 'slice':
-                    seed = np.zeros(batch[i].shape)
-                    r = np.random.choice(label.shape[0])
-                    while not np.any(label[r]):
-                        r = np.random.choice(label.shape[0])
-                    seed[r] = label[r]
-                elif self.seed_type == 'volume':
-                    seed = label.copy()
-                new_batch[i] = np.concatenate((batch[i], seed), axis=-1)
-            batch = new_batch
+            batch = add_seeds(batch, decoded['labels'], self.seed_type)
 
         if self.include_labels:
             if self.labels is None:
                 raise ValueError('No labels provided.')
 
-            labels = []
-            for file in self.labels[self.batch_size * idx:self.batch_size * (idx + 1)]:
-                label = file if self.load_files else preprocess(file, ['resize'])
-                labels.append(label)
-            labels = np.array(labels)
-            batch = (batch, labels)
+            batch = (batch, np.array(decoded['labels']))
         
         return batch
 
@@ -179,3 +348,143 @@ class VolumeGenerator(Sequence):
             return batch
         else:
             raise StopIteration()
+
+
+# memory maps opened by each bank worker, by bank directory
+_banks = {}
+
+
+def _open_bank(path, n, x_shape, y_shape, dtype, mode):
+    x = np.memmap(os.path.join(path, 'x.dat'), dtype=dtype, mode=mode, shape=(n,) + x_shape)
+    y = np.memmap(os.path.join(path, 'y.dat'), dtype=dtype, mode=mode, shape=(n,) + y_shape)
+    return x, y
+
+
+def _bank_arrays(path, n, x_shape, y_shape, dtype):
+    if path not in _banks:
+        context = os.path.join(path, 'context.npy')
+        _banks[path] = {
+            'inputs': np.load(os.path.join(path, 'inputs.npy'), mmap_mode='r'),
+            'labels': np.load(os.path.join(path, 'labels.npy'), mmap_mode='r'),
+            'context': np.load(context) if os.path.exists(context) else None,
+        }
+        _banks[path]['x'], _banks[path]['y'] = _open_bank(path, n, x_shape, y_shape, dtype, 'r+')
+    return _banks[path]
+
+
+def _fill_slot(args):
+    bank, transformer, slot, row, seed = args
+    arrays = _bank_arrays(*bank)
+    x = arrays['inputs'][row]
+    params = transformer.get_random_transform(x.shape, seed=seed)
+    arrays['x'][slot, ..., :x.shape[-1]] = transformer.apply_transform(x.astype(K.floatx()), params)
+    if arrays['context'] is not None:
+        arrays['x'][slot, ..., x.shape[-1]:] = transformer.apply_transform(arrays['context'], params)
+    arrays['y'][slot] = transformer.apply_transform(arrays['labels'][row].astype(K.floatx()), params)
+    return slot
+
+
+class AugmentBank(Sequence):
+    def __init__(self,
+                 input_files,
+                 label_files,
+                 batch_size=1,
+                 seed_type=None,
+                 concat_files=None,
+                 variants=8,
+                 refresh=0.,
+                 path=None,
+                 processes=None,
+                 dtype='float16',
+                 rotation_range=90.,
+                 shift_range=0.1,
+                 shear_range=0.1,
+                 zoom_range=0.1,
+                 fill_mode='nearest',
+                 cval=0.,
+                 flip=True,
+                 dataset=None,
+                 index=None,
+                 funcs=('rescale', 'resize')):
+        if dataset is not None:
+            self.inputs = dataset.inputs
+            self.labels = dataset.labels
+        else:
+            label_funcs = [f for f in funcs if f != 'rescale']
+            self.inputs = np.array([preprocess(file, funcs) for file in input_files])
+            self.labels = np.array([preprocess(file, funcs=label_funcs) for file in label_files])
+        self.index = np.arange(len(self.inputs)) if index is None else np.asarray(index)
+        self.concat = None if concat_files is None else load_context(concat_files)
+
+        self.batch_size = batch_size
+        self.seed_type = seed_type
+        self.variants = variants
+        self.refresh = refresh
+        self.n = len(self.index)
+
+        # slot s holds a warped copy of row self.index[s // variants]
+        slots = self.n * variants
+        x_shape, y_shape = self.inputs.shape[1:], self.labels.shape[1:]
+        if self.concat is not None:
+            x_shape = x_shape[:-1] + (x_shape[-1] + self.concat.shape[-1],)
+        self.owns_path = path is None
+        self.path = path if path is not None else tempfile.mkdtemp(prefix='augment_bank_')
+        os.makedirs(self.path, exist_ok=True)
+        self.x, self.y = _open_bank(self.path, slots, x_shape, y_shape, dtype, 'w+')
+
+        # spawned workers map the sources from disk; only the rows being banked are written
+        np.save(os.path.join(self.path, 'inputs.npy'), self.inputs[self.index])
+        np.save(os.path.join(self.path, 'labels.npy'), self.labels[self.index])
+        if self.concat is not None:
+            np.save(os.path.join(self.path, 'context.npy'), self.concat)
+        self.bank = (self.path, slots, x_shape, y_shape, dtype)
+        self.transformer = ImageTransformer(rotation_range=rotation_range,
+                                            shift_range=shift_range,
+                                            shear_range=shear_range,
+                                            zoom_range=zoom_range,
+                                            fill_mode=fill_mode,
+                                            cval=cval,
+                                            flip=flip)
+        # not forked: the parent already holds a TF session
+        self.pool = multiprocessing.get_context('spawn').Pool(processes)
+        self.pending = None
+        self.busy = set()
+        self.pool.map(_fill_slot, self._tasks(np.arange(slots)))
+
+    def _tasks(self, slots):
+        seeds = np.random.randint(2 ** 31, size=len(slots))
+        return [(self.bank, self.transformer, int(slot), int(slot // self.variants), int(seed))
+                for slot, seed in zip(slots, seeds)]
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        available = np.setdiff1d(np.arange(len(self.x)), list(self.busy), assume_unique=True)
+        slots = np.sort(np.random.choice(available, min(self.batch_size, len(available)), replace=False))
+        batch_x = np.asarray(self.x[slots], dtype=K.floatx())
+        batch_y = np.asarray(self.y[slots], dtype=K.floatx())
+        if self.seed_type is not None:
+            batch_x = add_seeds(batch_x, batch_y, self.seed_type)
+        return batch_x, batch_y
+
+    def on_epoch_end(self):
+        if not self.refresh:
+            return
+        if self.pending is not None:
+            self.pending.wait()
+        # rewarp a random fraction in the background; those slots are not sampled meanwhile
+        slots = np.random.choice(len(self.x), int(round(self.refresh * len(self.x))), replace=False)
+        self.busy = set(slots.tolist())
+        self.pending = self.pool.map_async(_fill_slot, self._tasks(slots), callback=lambda _: self.busy.clear())
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        del self.x, self.y
+        if self.owns_path:
+            shutil.rmtree(self.path)
+        else:
+            for name in ('inputs.npy', 'labels.npy', 'context.npy'):
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
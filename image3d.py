@@ -132,16 +132,15 @@ class ImageTransformer(object):
             raise ValueError('`shear_range` should be a float. '
                              'Received arg: ', shear_range)
 
-    def random_transform(self, x, y=None, seed=None):
-        """Randomly augment a single image tensor and optionally its label.
+    def get_random_transform(self, shape, seed=None):
+        """Draws random transformation parameters for an image.
 
         # Arguments
-            x: 3D tensor, single image.
-            y: 3D tensor, label of x. Must be the same shape as x.
+            shape: shape of the image the parameters are for.
             seed: random seed.
 
         # Returns
-            A randomly transformed version of the input and label (same shape).
+            A dictionary with the transform matrix (or None) and the axes to flip.
         """
         if seed is not None:
             np.random.seed(seed)
@@ -172,9 +171,9 @@ class ImageTransformer(object):
         if self.shift_range:
             tx, ty, tz = np.random.uniform(-self.shift_range, self.shift_range, 3)
             if self.shift_range < 1:
-                tx *= x.shape[0]
-                ty *= x.shape[1]
-                tz *= x.shape[2]
+                tx *= shape[0]
+                ty *= shape[1]
+                tz *= shape[2]
             shift_matrix = np.array([[1, 0, 0, tx],
                                      [0, 1, 0, ty],
                                      [0, 0, 1, tz],
@@ -197,8 +196,8 @@ class ImageTransformer(object):
             else:
                 transform_matrix = np.dot(transform_matrix, shear_matrix)
 
-        if self.zoom_range[0] == 1 and self.zoom_range[1] == 1:
-            zx, zy, zz = 1, 1, 1
+        if self.zoom_range[0] != 1 or self.zoom_range[1] != 1:
+            zx, zy, zz = np.random.uniform(self.zoom_range[0], self.zoom_range[1], 3)
             zoom_matrix = np.array([[zx, 0, 0, 0],
                                     [0, zy, 0, 0],
                                     [0, 0, zz, 0],
@@ -209,18 +208,45 @@ class ImageTransformer(object):
                 transform_matrix = np.dot(transform_matrix, zoom_matrix)
 
         if transform_matrix is not None:
-            transform_matrix = transform_matrix_offset_center(transform_matrix, x.shape)
-            x = apply_transform(x, transform_matrix, fill_mode=self.fill_mode, cval=self.cval)
-            if y is not None:
-                y = apply_transform(y, transform_matrix, fill_mode=self.fill_mode, cval=self.cval)
+            transform_matrix = transform_matrix_offset_center(transform_matrix, shape)
 
+        flips = []
         if self.flip:
-            for axis in range(3):
-                if np.random.random() < 0.5:
-                    x = flip_axis(x, axis)
-                    if y is not None:
-                        y = flip_axis(y, axis)
+            flips = [axis for axis in range(3) if np.random.random() < 0.5]
+
+        return {'transform_matrix': transform_matrix, 'flips': flips}
+
+    def apply_transform(self, x, params):
+        """Applies transformation parameters to an image.
+
+        # Arguments
+            x: 4D tensor, single image (any number of channels).
+            params: dictionary from `get_random_transform`.
+
+        # Returns
+            The transformed image.
+        """
+        if params['transform_matrix'] is not None:
+            x = apply_transform(x, params['transform_matrix'], fill_mode=self.fill_mode, cval=self.cval)
+        for axis in params['flips']:
+            x = flip_axis(x, axis)
+        return x
+
+    def random_transform(self, x, y=None, seed=None):
+        """Randomly augment a single image tensor and optionally its label.
+
+        # Arguments
+            x: 3D tensor, single image.
+            y: 3D tensor, label of x. Must be the same shape as x.
+            seed: random seed.
 
+        # Returns
+            A randomly transformed version of the input and label (same shape).
+        """
+        params = self.get_random_transform(x.shape, seed)
+        x = self.apply_transform(x, params)
+        if y is not None:
+            y = self.apply_transform(y, params)
         return x if y is None else (x, y)
 
 
@@ -327,11 +353,16 @@ class VolumeIterator(Iterator):
         shuffle: Boolean, whether to shuffle the data between epochs.
         seed: Random seed for data shuffling.
         generate_labels: If labels should be generated.
+        index: Optional array of rows of `x` (and `y`) to iterate over,
+            so that a subset can be used without copying the data.
+        context: Optional 4D array of channels shared by every volume. It is
+            stored once and appended to each input with the same transform.
     """
 
     def __init__(self, x, y, image_transformer,
-                 batch_size=32, shuffle=True, seed=None, generate_labels=True):
+                 batch_size=32, shuffle=True, seed=None, generate_labels=True, index=None, context=None):
         self.x = np.asarray(x, dtype=K.floatx())
+        self.context = None if context is None else np.asarray(context, dtype=K.floatx())
 
         if self.x.ndim != 5:
             raise ValueError('Input data in `VolumeIterator` '
@@ -344,26 +375,30 @@ class VolumeIterator(Iterator):
 
         self.image_transformer = image_transformer
         self.generate_labels = generate_labels
-        super().__init__(x.shape[0], batch_size, shuffle, seed)
+        self.index = np.arange(self.x.shape[0]) if index is None else np.asarray(index)
+        super().__init__(len(self.index), batch_size, shuffle, seed)
 
     def _get_batches_of_transformed_samples(self, index_array):
-        batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:]),
+        channels = self.x.shape[-1]
+        if self.context is not None:
+            channels += self.context.shape[-1]
+        batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:-1] + [channels]),
                            dtype=K.floatx())
-        if self.y is None:
-            for i, j in enumerate(index_array):
-                x = self.x[j]
-                x = self.image_transformer.random_transform(x.astype(K.floatx()))
-                batch_x[i] = x
-            return (batch_x, batch_x) if self.generate_labels else batch_x
-        
-        batch_y = np.zeros(tuple([len(index_array)] + list(self.y.shape)[1:]),
-                           dtype=K.floatx())      
+        batch_y = None
+        if self.y is not None:
+            batch_y = np.zeros(tuple([len(index_array)] + list(self.y.shape)[1:]),
+                               dtype=K.floatx())
         for i, j in enumerate(index_array):
-            x, y = self.x[j], self.y[j]
-            x, y = self.image_transformer.random_transform(x.astype(K.floatx()),
-                                                           y.astype(K.floatx()))
-            batch_x[i] = x
-            batch_y[i] = y
+            x = self.x[self.index[j]]
+            params = self.image_transformer.get_random_transform(x.shape)
+            batch_x[i, ..., :x.shape[-1]] = self.image_transformer.apply_transform(x.astype(K.floatx()), params)
+            if self.context is not None:
+                batch_x[i, ..., x.shape[-1]:] = self.image_transformer.apply_transform(self.context, params)
+            if batch_y is not None:
+                y = self.y[self.index[j]]
+                batch_y[i] = self.image_transformer.apply_transform(y.astype(K.floatx()), params)
+        if batch_y is None:
+            return (batch_x, batch_x) if self.generate_labels else batch_x
         return (batch_x, batch_y)
 
     def next(self):
@@ -0,0 +1,23 @@
+import json
+import os
+from util import atomic_write_json
+
+
+class Manifest:
+    def __init__(self, path, filename='.manifest.json'):
+        self.path = path
+        self.filename = os.path.join(path, filename)
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, output, record):
+        return (os.path.exists(os.path.join(self.path, output)) and
+                self.entries.get(output) == record)
+
+    def update(self, output, record):
+        self.entries[output] = record
+
+    def save(self):
+        atomic_write_json(self.entries, self.filename)
@@ -1,17 +1,36 @@
+import constants
+import h5py
+import hashlib
+import logging
+import numpy as np
 import os
+import re
+import resource
 import tensorflow as tf
+import time
 import util
+from analysis import SeriesTable, measure, series_time
+from callbacks import ScheduledValidation
 from datetime import datetime
+from keras.engine import Layer
 from keras.models import Model
 from keras.optimizers import Adam
 from keras import backend as K
+from keras import initializers
 from keras import layers
-from process import uncrop
+from keras import metrics
+from manifest import Manifest
+from parallel import train_parallel
+from process import crop, crop_offset, roi_bounds, uncrop
+from temporal import ChangeDetector
 
+BLOCKS = ('conv', 'factorised', 'separable')
+NORMS = (None, 'batch', 'instance')
 
 def dice_coef(y_true, y_pred):
-    y_true_f = K.flatten(y_true)
-    y_pred_f = K.flatten(y_pred)
+    # only the first channel is the segmentation; any others are auxiliary targets
+    y_true_f = K.flatten(y_true[..., :1])
+    y_pred_f = K.flatten(y_pred[..., :1])
     intersection = K.sum(y_true_f * y_pred_f)
     return (2. * intersection) / (K.sum(y_true_f) + K.sum(y_pred_f))
 
@@ -20,6 +39,21 @@ def dice_loss(y_true, y_pred):
     return 1 - dice_coef(y_true, y_pred)
 
 
+def acc(y_true, y_pred):
+    return metrics.binary_accuracy(y_true[..., :1], y_pred[..., :1])
+
+
+def evaluate(predict_on_batch, generator):
+    # acc and dice_coef for models Keras cannot evaluate, averaged over batches like evaluate_generator
+    results, samples = [], 0
+    for x, y in generator:
+        y_true, y_pred = y[..., :1], predict_on_batch(x)[..., :1]
+        dice = 2. * np.sum(y_true * y_pred) / (np.sum(y_true) + np.sum(y_pred))
+        results.append(np.array([np.mean(y_true == np.round(y_pred)), dice]) * len(x))
+        samples += len(x)
+    return list(np.sum(results, axis=0) / samples)
+
+
 def weighted_crossentropy(weight=None, boundary_weight=None, pool=3):
     w = (.5, .5) if weight is None else weight
     epsilon = K.epsilon()
@@ -40,185 +74,731 @@ def weighted_crossentropy(weight=None, boundary_weight=None, pool=3):
     return loss_fn
 
 
+def distillation_loss(weight=None, alpha=0.5, boundary_weight=None, online=True, pool=3):
+    hard_loss = weighted_crossentropy(weight=weight, boundary_weight=boundary_weight, pool=pool)
+    epsilon = K.epsilon()
+
+    def loss_fn(y_true, y_pred):
+        student = y_pred[..., :1]
+        # online: the frozen teacher's output is stacked onto the prediction,
+        # cached: its predictions were stacked onto the label beforehand
+        soft = K.stop_gradient(y_pred[..., 1:] if online else y_true[..., 1:])
+        student_clipped = K.clip(student, epsilon, 1 - epsilon)
+        soft_loss = -K.mean(soft * K.log(student_clipped) + (1 - soft) * K.log(1 - student_clipped))
+        return alpha * hard_loss(y_true[..., :1], student) + (1 - alpha) * soft_loss
+    return loss_fn
+
+
+class AccumulatingAdam(Adam):
+    """Adam that sums gradients over `accumulate` batches before each update."""
+
+    def __init__(self, accumulate=1, **kwargs):
+        super().__init__(**kwargs)
+        self.accumulate = accumulate
+
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        # use the incremented counter itself so every op sees the same step
+        iterations = K.update_add(self.iterations, 1)
+        self.updates = [iterations]
+        step = K.cast(K.equal(iterations % self.accumulate, 0), K.floatx())
+
+        lr = self.lr
+        if self.initial_decay > 0:
+            lr = lr * (1. / (1. + self.decay * K.cast(iterations // self.accumulate, K.dtype(self.decay))))
+
+        t = K.maximum(K.cast(iterations // self.accumulate, K.floatx()), 1.)
+        lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        gs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        self.weights = [self.iterations] + ms + vs + gs
+
+        for p, g, m, v, acc_g in zip(params, grads, ms, vs, gs):
+            g_t = acc_g + g / self.accumulate
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g_t
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g_t)
+            p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+
+            self.updates.append(K.update(m, step * m_t + (1 - step) * m))
+            self.updates.append(K.update(v, step * v_t + (1 - step) * v))
+            self.updates.append(K.update(acc_g, (1 - step) * g_t))
+            new_p = step * p_t + (1 - step) * p
+            if getattr(p, 'constraint', None) is not None:
+                new_p = p.constraint(new_p)
+            self.updates.append(K.update(p, new_p))
+        return self.updates
+
+    def get_config(self):
+        config = {'accumulate': self.accumulate}
+        config.update(super().get_config())
+        return config
+
+
+def optimizer(lr=1e-4, accumulate=1):
+    return Adam(lr=lr) if accumulate <= 1 else AccumulatingAdam(lr=lr, accumulate=accumulate)
+
+
+def peak_memory():
+    if tf.test.is_gpu_available():
+        return K.get_session().run(tf.contrib.memory_stats.MaxBytesInUse())
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def depthwise_conv3d(inputs, kernel):
+    # fold the last spatial axis into the batch and sum one native depthwise
+    # 2D convolution per kernel slice along it
+    k = K.int_shape(kernel)[2]
+    pad = k // 2
+    shape = tf.shape(inputs)
+    channels = K.int_shape(inputs)[-1]
+    x = tf.pad(inputs, [[0, 0], [0, 0], [0, 0], [pad, pad], [0, 0]])
+    x = tf.transpose(x, [0, 3, 1, 2, 4])
+    depth = shape[3] + 2 * pad
+    x = tf.reshape(x, [-1, shape[1], shape[2], channels])
+    outputs = 0
+    for kz in range(k):
+        y = tf.nn.depthwise_conv2d(x, kernel[:, :, kz], strides=[1, 1, 1, 1], padding='SAME')
+        y = tf.reshape(y, [shape[0], depth, shape[1], shape[2], channels])
+        outputs += y[:, kz:kz + shape[3]]
+    return tf.transpose(outputs, [0, 2, 3, 1, 4])
+
+
+class DepthwiseConv3D(Layer):
+    def __init__(self, kernel_size=3, kernel_initializer='glorot_uniform', **kwargs):
+        super().__init__(**kwargs)
+        self.kernel_size = kernel_size
+        self.kernel_initializer = initializers.get(kernel_initializer)
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name='kernel',
+                                      shape=(self.kernel_size,) * 3 + (input_shape[-1], 1),
+                                      initializer=self.kernel_initializer)
+        super().build(input_shape)
+
+    def call(self, inputs):
+        return depthwise_conv3d(inputs, self.kernel)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {'kernel_size': self.kernel_size,
+                  'kernel_initializer': initializers.serialize(self.kernel_initializer)}
+        config.update(super().get_config())
+        return config
+
+
+def instance_norm(x):
+    mean, var = tf.nn.moments(x, axes=[1, 2, 3], keep_dims=True)
+    return (x - mean) / K.sqrt(var + K.epsilon())
+
+
+def _block_forward(x, weights, block, norm):
+    # conv_block written against explicit weight tensors, in the same weight order
+    weights = iter(weights)
+    for i in range(2):
+        if block == 'conv':
+            x = K.bias_add(K.conv3d(x, next(weights), padding='same'), next(weights))
+        elif block == 'factorised':
+            x = K.relu(K.bias_add(K.conv3d(x, next(weights), padding='same'), next(weights)))
+            x = K.bias_add(K.conv3d(x, next(weights), padding='same'), next(weights))
+        elif block == 'separable':
+            x = depthwise_conv3d(x, next(weights))
+            x = K.bias_add(K.conv3d(x, next(weights)), next(weights))
+        if norm == 'instance':
+            x = instance_norm(x)
+        x = K.relu(x)
+    return x
+
+
+class CheckpointedBlock(Layer):
+    """conv_block that keeps only its input and weights for the backward pass.
+
+    The intermediate activations are recomputed from them when the gradient
+    is needed, trading one extra forward pass of the block for their memory.
+    """
+
+    def __init__(self, filters, block='conv', norm=None, **kwargs):
+        super().__init__(**kwargs)
+        if block not in BLOCKS:
+            raise ValueError('Block type {} not defined.'.format(block))
+        if norm not in (None, 'instance'):
+            raise ValueError('Normalisation {} cannot be recomputed.'.format(norm))
+        self.filters = filters
+        self.block = block
+        self.norm = norm
+
+    def build(self, input_shape):
+        channels = input_shape[-1]
+        for i in range(2):
+            prefix = '{}_{}'.format(self.name, i)
+            if self.block == 'conv':
+                shapes = [('_conv', (3, 3, 3, channels, self.filters))]
+            elif self.block == 'factorised':
+                shapes = [('_conv_xy', (3, 3, 1, channels, self.filters)),
+                          ('_conv_z', (1, 1, 3, self.filters, self.filters))]
+            else:
+                shapes = [('_depthwise', (3, 3, 3, channels, 1)),
+                          ('_pointwise', (1, 1, 1, channels, self.filters))]
+            for suffix, shape in shapes:
+                self.add_weight(name=prefix + suffix + '_kernel', shape=shape, initializer='glorot_uniform')
+                if suffix != '_depthwise':
+                    self.add_weight(name=prefix + suffix + '_bias', shape=shape[-1:], initializer='zeros')
+            channels = self.filters
+        super().build(input_shape)
+
+    def call(self, inputs):
+        block, norm = self.block, self.norm
+
+        @tf.custom_gradient
+        def forward(x, *weights):
+            def grad(dy):
+                # recompute only once the incoming gradient exists, so nothing is held from the forward pass
+                with tf.control_dependencies([dy]):
+                    x_ = tf.identity(x)
+                    weights_ = [tf.identity(w) for w in weights]
+                y = _block_forward(x_, weights_, block, norm)
+                return tf.gradients(y, [x_] + weights_, grad_ys=dy)
+            return _block_forward(x, weights, block, norm), grad
+
+        return forward(inputs, *[tf.convert_to_tensor(w) for w in self.weights])
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:-1] + (self.filters,)
+
+    def get_config(self):
+        config = {'filters': self.filters, 'block': self.block, 'norm': self.norm}
+        config.update(super().get_config())
+        return config
+
+
+def conv_block(x, filters, block='conv', norm=None, name=None, checkpoint=False):
+    if checkpoint:
+        return CheckpointedBlock(filters, block, norm, name=name)(x)
+    activation = 'relu' if norm is None else None
+    for i in range(2):
+        prefix = '{}_{}'.format(name, i)
+        if block == 'conv':
+            x = layers.Conv3D(filters, (3, 3, 3), activation=activation, padding='same', name=prefix + '_conv')(x)
+        elif block == 'factorised':
+            x = layers.Conv3D(filters, (3, 3, 1), activation='relu', padding='same', name=prefix + '_conv_xy')(x)
+            x = layers.Conv3D(filters, (1, 1, 3), activation=activation, padding='same', name=prefix + '_conv_z')(x)
+        elif block == 'separable':
+            x = DepthwiseConv3D(3, name=prefix + '_depthwise')(x)
+            x = layers.Conv3D(filters, (1, 1, 1), activation=activation, name=prefix + '_pointwise')(x)
+        else:
+            raise ValueError('Block type {} not defined.'.format(block))
+
+        if norm == 'batch':
+            x = layers.BatchNormalization(name=prefix + '_norm')(x)
+        elif norm == 'instance':
+            x = layers.Lambda(instance_norm, name=prefix + '_norm')(x)
+        elif norm is not None:
+            raise ValueError('Normalisation {} not defined.'.format(norm))
+        if norm is not None:
+            x = layers.Activation('relu', name=prefix + '_relu')(x)
+    return x
+
+
+def checkpointed(name, checkpoint):
+    # checkpoint: None, 'encoder', 'all' or a list of block names
+    if checkpoint is None:
+        return False
+    if checkpoint == 'all':
+        return True
+    if checkpoint == 'encoder':
+        return name.startswith('enc')
+    if isinstance(checkpoint, str):
+        raise ValueError('Checkpointing {} not defined.'.format(checkpoint))
+    return name in checkpoint
+
+
+def build_unet(input_size, depth=4, filters=32, block='conv', norm=None, name=None, checkpoint=None):
+    inputs = layers.Input(shape=input_size)
+
+    x = inputs
+    skips = []
+    for level in range(depth):
+        block_name = 'enc{}'.format(level)
+        x = conv_block(x, filters * 2 ** level, block, norm, name=block_name,
+                       checkpoint=checkpointed(block_name, checkpoint))
+        skips.append(x)
+        x = layers.MaxPooling3D(pool_size=(2, 2, 2))(x)
+
+    x = conv_block(x, filters * 2 ** depth, block, norm, name='bottleneck',
+                   checkpoint=checkpointed('bottleneck', checkpoint))
+
+    for level in reversed(range(depth)):
+        x = layers.Conv3DTranspose(filters * 2 ** level, (2, 2, 2), strides=(2, 2, 2), padding='same',
+                                   name='dec{}_up'.format(level))(x)
+        x = layers.concatenate([x, skips[level]])
+        block_name = 'dec{}'.format(level)
+        x = conv_block(x, filters * 2 ** level, block, norm, name=block_name,
+                       checkpoint=checkpointed(block_name, checkpoint))
+
+    outputs = layers.Conv3D(1, (1, 1, 1), activation='sigmoid', name='output')(x)
+
+    return Model(inputs=inputs, outputs=outputs, name=name)
+
+
+def _weight_keys(model):
+    # one name per kernel and bias, the same whether or not its block is a CheckpointedBlock
+    keys = []
+    for layer in model.layers:
+        for w in layer.weights:
+            short = w.name.split('/')[-1].split(':')[0]
+            keys.append((short if isinstance(layer, CheckpointedBlock) else '{}_{}'.format(layer.name, short), w))
+    return keys
+
+
+def saved_checkpoint(filename):
+    # the blocks a weights file stores as CheckpointedBlocks, as a build_unet checkpoint argument
+    with h5py.File(filename, 'r') as f:
+        group = f['model_weights'] if 'layer_names' not in f.attrs and 'model_weights' in f else f
+        names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['layer_names']]
+    blocks = sorted(n for n in names if n == 'bottleneck' or re.fullmatch(r'(enc|dec)\d+', n))
+    return blocks or None
+
+
+def count_flops(model):
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            flops += count_flops(layer)
+        elif isinstance(layer, layers.Conv3DTranspose):
+            kernel = np.prod(layer.kernel_size)
+            flops += 2 * kernel * layer.filters * np.prod(layer.input_shape[1:])
+        elif isinstance(layer, layers.Conv3D):
+            kernel = np.prod(layer.kernel_size) * layer.input_shape[-1]
+            flops += 2 * kernel * np.prod(layer.output_shape[1:])
+        elif isinstance(layer, DepthwiseConv3D):
+            flops += 2 * layer.kernel_size ** 3 * np.prod(layer.output_shape[1:])
+        elif isinstance(layer, CheckpointedBlock):
+            voxels = np.prod(layer.output_shape[1:-1])
+            flops += sum(2 * np.prod(K.int_shape(w)) * voxels for w in layer.trainable_weights if K.ndim(w) == 5)
+    return int(flops)
+
+
+class _Output:
+    def __init__(self, model, path, generator, hashes, resume=True, measures=False, skip_threshold=None,
+                 incremental=False, margin=16):
+        self.model = model
+        self.path = path
+        self.manifest = Manifest(path) if resume else None
+        self.table = SeriesTable(path) if measures else None
+        self.touched = set()
+        self.detector = None
+        # the seed is the last input channel; cached per output to find what an edit changed
+        self.seeded = generator.seeds is not None or generator.seed_type == 'volume'
+        # the cache is only read by incremental runs, which also need the manifest
+        self.cache_seeds = incremental and resume and self.seeded
+        self.seed_path = os.path.join(path, '.seeds')
+        self.margin = margin
+        self.refine = set()
+        names = [os.path.basename(generator.file(i)) for i in range(generator.n)]
+        self.records = {}
+        self.todo = set(names)
+        if self.manifest is not None:
+            weights = model.weights_hash()
+            config = generator.config()
+            if skip_threshold is not None:
+                config['skip_threshold'] = skip_threshold
+            self.records = {name: {'inputs': hashes[i], 'weights': weights, 'config': config}
+                            for i, name in enumerate(names)}
+            self.todo = {name for name in names if not self.manifest.is_current(name, self.records[name])}
+            if self.table is not None:
+                # outputs written before --measure (or by an interrupted run) have no rows yet
+                self.todo |= {name for name in names if not self.table.has(name)}
+            logging.info('{}: {} of {} outputs up to date.'.format(path, generator.n - len(self.todo), generator.n))
+            # maps written beside the mask are not cached, so their edited region cannot be patched in
+            if incremental and self.seeded and None in tuple(model.input_size)[:3] and not model.extra_outputs:
+                self.refine = {name for name in self.todo if self._seed_edit(name)}
+                logging.info('{}: {} outputs only need their edited region.'.format(path, len(self.refine)))
+        if skip_threshold is not None and self.todo:
+            self.detector = ChangeDetector(skip_threshold, path)
+
+    def _seed_edit(self, name):
+        # same image, weights and preprocessing as the existing output; only seed/label files differ
+        previous, record = self.manifest.entries.get(name), self.records[name]
+        return (previous is not None and
+                os.path.exists(os.path.join(self.path, name)) and
+                os.path.exists(os.path.join(self.seed_path, name + '.npy')) and
+                previous['weights'] == record['weights'] and
+                previous['config'] == record['config'] and
+                previous['inputs'][:1] == record['inputs'][:1])
+
+    def _refined(self, x, name, offset):
+        # re-segment a window around the voxels whose seed changed and paste it into the old mask
+        old_seed = np.load(os.path.join(self.seed_path, name + '.npy'))
+        if old_seed.shape != x[..., -1:].shape:
+            # the window moved or changed size since the last run
+            return self.model.model.predict_on_batch(x[np.newaxis])[0]
+        pred = crop(util.read_vol(os.path.join(self.path, name)), offset, x.shape[:3]).astype(K.floatx())
+        changed = np.any(old_seed != x[..., -1:], axis=-1)
+        if not np.any(changed):
+            return pred
+        window, merge = roi_bounds(changed, self.margin, 2 ** self.model.params['depth'])
+        roi = self.model.model.predict_on_batch(x[window][np.newaxis])[0]
+        inner = tuple(slice(m.start - w.start, m.stop - w.start) for m, w in zip(merge, window))
+        pred[merge] = roi[inner]
+        return pred
+
+    def write(self, batch, files, offsets, shape, rescale=True):
+        names = [os.path.basename(f) for f in files]
+        if self.detector is None:
+            full = [i for i, name in enumerate(names) if name not in self.refine]
+            preds = [None] * len(names)
+            if full:
+                for i, pred in zip(full, self.model.model.predict_on_batch(batch[full])):
+                    preds[i] = pred
+            for i, name in enumerate(names):
+                if preds[i] is None:
+                    preds[i] = self._refined(batch[i], name, offsets[i])
+            preds = np.array(preds)
+        else:
+            need, sources = self.detector.plan(batch, names)
+            preds = self.model.model.predict_on_batch(batch[need]) if need else None
+            preds = self.detector.assemble(preds, sources)
+        preds, extras = self.model.split_outputs(preds)
+        crop_offsets, voxel_volumes = [], []
+        for i, f in enumerate(files):
+            header = util.header(f)
+            util.save_vol(uncrop(preds[i], shape, offsets[i]), os.path.join(self.path, names[i]), header)
+            for extra, maps in extras.items():
+                os.makedirs(os.path.join(self.path, extra), exist_ok=True)
+                util.save_vol(uncrop(maps[i], shape, offsets[i]), os.path.join(self.path, extra, names[i]), header,
+                              dtype='float32')
+            crop_offsets.append(crop_offset(shape) if offsets[i] is None else offsets[i])
+            voxel_volumes.append(np.prod(header.get_zooms()[:3]))
+            if self.manifest is not None:
+                self.manifest.update(names[i], self.records[names[i]])
+            if self.cache_seeds:
+                os.makedirs(self.seed_path, exist_ok=True)
+                np.save(os.path.join(self.seed_path, names[i] + '.npy'), batch[i, ..., -1:].astype(np.float16))
+
+        if self.table is not None:
+            volumes = batch[..., :1]
+            if rescale:
+                volumes = volumes * constants.MAX_VALUE
+            self.touched |= self.table.append(names, measure(preds, volumes, crop_offsets, voxel_volumes))
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def close(self):
+        if self.detector is not None:
+            self.detector.close()
+        # written once; rewriting the CSVs after every batch is quadratic in the series length
+        if self.table is not None:
+            self.table.save(self.touched)
+
+
+def predict_models(models, generator, paths, resume=True, measures=False, skip_threshold=None, incremental=False):
+    # every input is decoded and preprocessed once, then fanned out to all models
+    if len(models) != len(paths):
+        raise ValueError('{} models but {} output paths.'.format(len(models), len(paths)))
+    for model in models[1:]:
+        if tuple(model.input_size) != tuple(models[0].input_size):
+            raise ValueError('Models take different inputs: {} and {}.'.format(models[0].input_size,
+                                                                              model.input_size))
+    if skip_threshold is not None and generator.crops_per_volume:
+        raise ValueError('Skipping unchanged frames needs every frame cropped at the same window.')
+    hashes = None
+    if resume:
+        hashes = [[util.file_hash(f) for f in generator.sources(i)] for i in range(generator.n)]
+    outputs = [_Output(model, path, generator, hashes, resume=resume, measures=measures,
+                       skip_threshold=skip_threshold, incremental=incremental and skip_threshold is None)
+               for model, path in zip(models, paths)]
+
+    todo = set().union(*(output.todo for output in outputs))
+    order = [i for i in range(generator.n) if os.path.basename(generator.file(i)) in todo]
+    if not order:
+        return
+    if skip_threshold is not None:
+        # change detection compares consecutive time points, so visit them in order
+        order.sort(key=lambda i: series_time(generator.file(i)))
+    generator = generator.subset(order)
+
+    for idx in range(len(generator)):
+        batch = generator[idx]
+        start = generator.batch_size * idx
+        rows = range(start, start + len(batch))
+        files = [generator.file(j) for j in rows]
+        offsets = [generator.offset(j) for j in rows]
+        for output in outputs:
+            keep = [i for i, f in enumerate(files) if os.path.basename(f) in output.todo]
+            if not keep:
+                continue
+            if len(keep) < len(files):
+                output.write(batch[keep], [files[i] for i in keep], [offsets[i] for i in keep],
+                             generator.shape, 'rescale' in generator.funcs)
+            else:
+                output.write(batch, files, offsets, generator.shape, 'rescale' in generator.funcs)
+    generator.close()
+
+    for output in outputs:
+        output.close()
+
+
 class BaseModel:
+    params = {}
+    # maps predicted beside the segmentation, each saved as float volumes in a subdirectory of that name
+    extra_outputs = ()
+
     def __init__(self, input_size, name=None, filename=None):
         self.input_size = input_size
         self.name = name if name else self.__class__.__name__.lower()
         self._new_model()
         if filename is not None:
-            self.model.load_weights(filename)
+            self.load_weights(filename)
+        self.trainer = self.model
 
     def _new_model(self):
         raise NotImplementedError()
 
+    def load_weights(self, filename):
+        self.model.load_weights(filename)
+
     def save(self):
-        self.model.save('models/{}_weights.{}.h5'.format(self.name, datetime.now().strftime('%m.%d.%y-%H:%M:%S')))
+        filename = 'models/{}_weights.{}.h5'.format(self.name, datetime.now().strftime('%m.%d.%y-%H:%M:%S'))
+        self.model.save(filename)
+        return filename
 
     def compile(self, weight):
         raise NotImplementedError()
 
-    def train(self, generator, val_gen, epochs):
-        self.model.fit_generator(generator,
-                                 epochs=epochs,
-                                 validation_data=val_gen,
-                                 verbose=1)
-
-    def predict(self, generator, path):
-        preds = self.model.predict_generator(generator, verbose=1)
-        # FIXME
-        for i in range(preds.shape[0]):
-            fname = generator.inputs[i].split('/')[-1]
-            header = util.header(generator.inputs[i])
-            util.save_vol(uncrop(preds[i], generator.shape), os.path.join(path, fname), header)
+    def train(self, generator, val_gen, epochs, val_every=1, val_samples=None, streaming=False, callbacks=None,
+              initial_epoch=0, workers=1, sync_every=10):
+        callbacks = [] if callbacks is None else callbacks
+        if workers > 1:
+            if callbacks:
+                raise ValueError('Callbacks are not run in data-parallel training.')
+            if val_every != 1 or val_samples is not None or streaming:
+                raise ValueError('Data-parallel training validates every epoch with evaluate_generator.')
+            return train_parallel(self, generator, val_gen, epochs, workers, sync_every=sync_every,
+                                  initial_epoch=initial_epoch)
+        if val_gen is not None and (val_every != 1 or val_samples is not None or streaming):
+            callbacks = [ScheduledValidation(val_gen, every=val_every, samples=val_samples,
+                                             streaming=streaming)] + callbacks
+            val_gen = None
+        return self.trainer.fit_generator(generator,
+                                          epochs=epochs,
+                                          validation_data=val_gen,
+                                          callbacks=callbacks,
+                                          initial_epoch=initial_epoch,
+                                          verbose=1)
+
+    def autotune(self, max_batch_size=64, memory_budget=None, steps=3):
+        shape = self.sample_shape()
+        out_channels = self.trainer.output_shape[-1]
+        weights = self.trainer.get_weights()
+
+        best, best_throughput = 1, 0.
+        batch_size = 1
+        while batch_size <= max_batch_size:
+            x = np.zeros((batch_size,) + shape, dtype=K.floatx())
+            y = np.zeros((batch_size,) + shape[:-1] + (out_channels,), dtype=K.floatx())
+            try:
+                self.trainer.train_on_batch(x, y)
+                start = time.time()
+                for _ in range(steps):
+                    self.trainer.train_on_batch(x, y)
+                throughput = batch_size * steps / (time.time() - start)
+            except (tf.errors.ResourceExhaustedError, MemoryError):
+                logging.info('batch size {}: out of memory'.format(batch_size))
+                break
+            memory = peak_memory()
+            logging.info('batch size {}: {:.2f} volumes/s, peak memory {:.2f} GB'.format(
+                batch_size, throughput, memory / 2 ** 30))
+            if memory_budget is not None and memory > memory_budget:
+                break
+            if throughput > best_throughput:
+                best, best_throughput = batch_size, throughput
+            batch_size *= 2
+
+        # undo the probe steps: restore the weights and reset the optimiser to its initial state
+        self.trainer.set_weights(weights)
+        optimizer_weights = self.trainer.optimizer.get_weights()
+        self.trainer.optimizer.set_weights([np.zeros_like(w) for w in optimizer_weights])
+        return best
+
+    def weights_hash(self):
+        h = hashlib.sha1()
+        for w in self.model.get_weights():
+            h.update(w.tobytes())
+        return h.hexdigest()
+
+    def predict(self, generator, path, resume=True, measures=False, skip_threshold=None, incremental=False):
+        predict_models([self], generator, [path], resume=resume, measures=measures, skip_threshold=skip_threshold,
+                       incremental=incremental)
 
     def test(self, generator):
         return self.model.evaluate_generator(generator)
 
+    def split_outputs(self, preds):
+        return preds, {}
+
+    def sample_shape(self):
+        # input_size with free spatial dimensions at TARGET_SHAPE
+        return tuple(constants.TARGET_SHAPE[i] if d is None else d
+                     for i, d in enumerate(self.input_size[:-1])) + tuple(self.input_size[-1:])
+
+    def profile(self, batch_size=1, repeats=10):
+        shape = self.sample_shape()
+        model = self.model
+        if shape != tuple(self.input_size):
+            model = self.__class__(shape, **self.params).model
+            model.set_weights(self.model.get_weights())
+
+        x = np.zeros((batch_size,) + shape, dtype=K.floatx())
+        model.predict_on_batch(x)
+        times = []
+        for _ in range(repeats):
+            start = time.time()
+            model.predict_on_batch(x)
+            times.append(time.time() - start)
+
+        return {
+            'params': model.count_params(),
+            'flops': count_flops(model) * batch_size,
+            'latency': float(np.median(times)),
+        }
+
+    def profile_training(self, batch_size=1, repeats=5):
+        # peak memory is per process, so compare variants measured in separate processes
+        shape = self.sample_shape()
+        x = np.zeros((batch_size,) + shape, dtype=K.floatx())
+        y = np.zeros((batch_size,) + shape[:-1] + (self.trainer.output_shape[-1],), dtype=K.floatx())
+        self.trainer.train_on_batch(x, y)
+        times = []
+        for _ in range(repeats):
+            start = time.time()
+            self.trainer.train_on_batch(x, y)
+            times.append(time.time() - start)
+        return {'step_time': float(np.median(times)), 'peak_memory': int(peak_memory())}
 
-class UNet(BaseModel):
-    def _new_model(self):
-        inputs = layers.Input(shape=self.input_size)
-
-        conv1 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(inputs)
-        conv1 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conv1)
-        pool1 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv1)
-
-        conv2 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(pool1)
-        conv2 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conv2)
-        pool2 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv2)
-
-        conv3 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(pool2)
-        conv3 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conv3)
-        pool3 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv3)
-
-        conv4 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(pool3)
-        conv4 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(conv4)
-        pool4 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv4)
 
-        conv5 = layers.Conv3D(512, (3, 3, 3), activation='relu', padding='same')(pool4)
-        conv5 = layers.Conv3D(512, (3, 3, 3), activation='relu', padding='same')(conv5)
-
-        up6 = layers.Conv3DTranspose(256, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv5)
-        conc6 = layers.concatenate([up6, conv4])
-        conv6 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(conc6)
-        conv6 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(conv6)
-
-        up7 = layers.Conv3DTranspose(128, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv6)
-        conc7 = layers.concatenate([up7, conv3])
-        conv7 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conc7)
-        conv7 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conv7)
-
-        up8 = layers.Conv3DTranspose(64, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv7)
-        conc8 = layers.concatenate([up8, conv2])
-        conv8 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conc8)
-        conv8 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conv8)
-
-        up9 = layers.Conv3DTranspose(32, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv8)
-        conc9 = layers.concatenate([up9, conv1])
-        conv9 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conc9)
-        conv9 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conv9)
-
-        outputs = layers.Conv3D(1, (1, 1, 1), activation='sigmoid')(conv9)
-
-        self.model = Model(inputs=inputs, outputs=outputs)
-
-    def compile(self, weight):
-        self.model.compile(optimizer=Adam(lr=1e-4),
-                           loss=weighted_crossentropy(weight=weight, boundary_weight=0.2),
-                           metrics=['accuracy', dice_coef])
+class UNet(BaseModel):
+    params = {'depth': 4, 'filters': 32, 'block': 'conv', 'norm': None, 'checkpoint': None}
 
+    def __init__(self, input_size, name=None, filename=None, **params):
+        self.params = dict(self.params, **params)
+        super().__init__(input_size, name=name, filename=filename)
 
-class UNetSmall(UNet):
     def _new_model(self):
-        inputs = layers.Input(shape=self.input_size)
-
-        conv1 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(inputs)
-        conv1 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(conv1)
-        pool1 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv1)
+        self.model = build_unet(self.input_size, **self.params)
 
-        conv2 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(pool1)
-        conv2 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conv2)
-        pool2 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv2)
-
-        conv3 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(pool2)
-        conv3 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conv3)
-        pool3 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv3)
-
-        conv4 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(pool3)
-        conv4 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conv4)
+    def load_weights(self, filename):
+        saved = saved_checkpoint(filename)
+        current = sorted(layer.name for layer in self.model.layers if isinstance(layer, CheckpointedBlock)) or None
+        if saved == current:
+            self.model.load_weights(filename)
+            return
+        # a CheckpointedBlock holds its convolutions' weights as one layer, so Keras cannot load across
+        # layouts; load into the saved layout and copy the weights over by name
+        source = build_unet(self.input_size, **dict(self.params, checkpoint=saved))
+        source.load_weights(filename)
+        keys = _weight_keys(source)
+        values = dict(zip([key for key, _ in keys], K.batch_get_value([w for _, w in keys])))
+        K.batch_set_value([(w, values[key]) for key, w in _weight_keys(self.model)])
+
+    def freeze_encoder(self):
+        # takes effect at the next compile
+        for layer in self.model.layers:
+            if layer.name.startswith('enc'):
+                layer.trainable = False
+
+    def compile(self, weight, alpha=None, teacher=None, accumulate=1, boundary_weight=0.2, pool=3):
+        self.compile_args = {'weight': weight, 'accumulate': accumulate, 'boundary_weight': boundary_weight,
+                             'pool': pool}
+        self.model.compile(optimizer=optimizer(accumulate=accumulate),
+                           loss=weighted_crossentropy(weight=weight, boundary_weight=boundary_weight, pool=pool),
+                           metrics=[acc, dice_coef])
+        self.trainer = self.model
+
+        if alpha is not None:
+            # the student stays self.model; the trainer shares its layers
+            if teacher is not None:
+                teacher.model.trainable = False
+                outputs = layers.concatenate([self.model.output, teacher.model(self.model.input)])
+            else:
+                outputs = self.model.output
+            self.trainer = Model(inputs=self.model.input, outputs=outputs)
+            self.trainer.compile(optimizer=optimizer(accumulate=accumulate),
+                                 loss=distillation_loss(weight=weight, alpha=alpha, boundary_weight=boundary_weight,
+                                                        online=teacher is not None, pool=pool),
+                                 metrics=[acc, dice_coef])
 
-        up5 = layers.Conv3DTranspose(64, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv4)
-        conc5 = layers.concatenate([up5, conv3])
-        conv5 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conc6)
-        conv5 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conv5)
 
-        up6 = layers.Conv3DTranspose(32, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv5)
-        conc6 = layers.concatenate([up6, conv2])
-        conv6 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conc6)
-        conv6 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conv6)
+class UNetSmall(UNet):
+    params = dict(UNet.params, depth=3, filters=16)
 
-        up7 = layers.Conv3DTranspose(16, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv6)
-        conc7 = layers.concatenate([up7, conv1])
-        conv7 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(conc7)
-        conv7 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(conv7)
 
-        outputs = layers.Conv3D(1, (1, 1, 1), activation='sigmoid')(conv7)
+class UNetBig(UNet):
+    params = dict(UNet.params, depth=5, filters=16)
 
-        self.model = Model(inputs=inputs, outputs=outputs)
 
+class UNetTiny(UNet):
+    params = dict(UNet.params, depth=3, filters=8)
 
-class UNetBig(UNet):
-    def _new_model(self):
-        inputs = layers.Input(shape=self.input_size)
 
-        conv1 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(inputs)
-        conv1 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(conv1)
-        pool1 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv1)
+UNETS = {
+    'tiny': UNetTiny,
+    'small': UNetSmall,
+    'normal': UNet,
+    'big': UNetBig,
+}
 
-        conv2 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(pool1)
-        conv2 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conv2)
-        pool2 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv2)
 
-        conv3 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(pool2)
-        conv3 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conv3)
-        pool3 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv3)
+def unet(size, input_size, name=None, filename=None, **params):
+    m = UNETS.get(size or 'normal')
+    if m is None:
+        raise ValueError('UNet size {} not defined.'.format(size))
+    return m(input_size, name=name, filename=filename, **params)
 
-        conv4 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(pool3)
-        conv4 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conv4)
-        pool4 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv4)
 
-        conv5 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(pool4)
-        conv5 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(conv5)
-        pool5 = layers.MaxPooling3D(pool_size=(2, 2, 2))(conv5)
+def training_profile(size, input_size, batch_size=1, **params):
+    # meant to run in a fresh process so peak memory belongs to this variant alone
+    model = unet(size, input_size, **params)
+    model.compile(None)
+    return model.profile_training(batch_size=batch_size)
 
-        conv6 = layers.Conv3D(512, (3, 3, 3), activation='relu', padding='same')(pool5)
-        conv6 = layers.Conv3D(512, (3, 3, 3), activation='relu', padding='same')(conv6)
 
-        up7 = layers.Conv3DTranspose(256, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv6)
-        conc7 = layers.concatenate([up7, conv5])
-        conv7 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(conc7)
-        conv7 = layers.Conv3D(256, (3, 3, 3), activation='relu', padding='same')(conv7)
+class Ensemble(BaseModel):
+    """Trained models run as one graph on a shared input.
 
-        up8 = layers.Conv3DTranspose(128, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv7)
-        conc8 = layers.concatenate([up8, conv4])
-        conv8 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conc8)
-        conv8 = layers.Conv3D(128, (3, 3, 3), activation='relu', padding='same')(conv8)
+    The first output channels are the mean of the members' probabilities, the
+    rest their voxelwise standard deviation as a disagreement map.
+    """
+    extra_outputs = ('std',)
 
-        up9 = layers.Conv3DTranspose(64, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv8)
-        conc9 = layers.concatenate([up9, conv3])
-        conv9 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conc9)
-        conv9 = layers.Conv3D(64, (3, 3, 3), activation='relu', padding='same')(conv9)
+    def __init__(self, members, name='ensemble'):
+        for member in members[1:]:
+            if tuple(member.input_size) != tuple(members[0].input_size):
+                raise ValueError('Models take different inputs: {} and {}.'.format(members[0].input_size,
+                                                                                  member.input_size))
+        self.members = members
+        # windows for incremental prediction have to suit the deepest member
+        self.params = {'depth': max(member.params.get('depth', 0) for member in members)}
+        super().__init__(members[0].input_size, name=name)
 
-        up10 = layers.Conv3DTranspose(32, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv9)
-        conc10 = layers.concatenate([up10, conv2])
-        conv10 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conc10)
-        conv10 = layers.Conv3D(32, (3, 3, 3), activation='relu', padding='same')(conv10)
+    def _new_model(self):
+        inputs = layers.Input(self.input_size)
+        outputs = [member.model(inputs) for member in self.members]
+        stacked = layers.Lambda(lambda x: K.stack(x, axis=-1))(outputs)
+        mean = layers.Lambda(lambda x: K.mean(x, axis=-1))(stacked)
+        std = layers.Lambda(lambda x: K.std(x, axis=-1))(stacked)
+        self.model = Model(inputs=inputs, outputs=layers.concatenate([mean, std]))
 
-        up11 = layers.Conv3DTranspose(16, (2, 2, 2), strides=(2, 2, 2), padding='same')(conv10)
-        conc11 = layers.concatenate([up11, conv1])
-        conv11 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(conc11)
-        conv11 = layers.Conv3D(16, (3, 3, 3), activation='relu', padding='same')(conv11)
+    def save(self):
+        raise TypeError('Ensembles are rebuilt from their members.')
 
-        outputs = layers.Conv3D(1, (1, 1, 1), activation='sigmoid')(conv11)
+    def test(self, generator):
+        # scores the mean; evaluate only reads the first channel
+        return evaluate(self.model.predict_on_batch, generator)
 
-        self.model = Model(inputs=inputs, outputs=outputs)
+    def split_outputs(self, preds):
+        channels = preds.shape[-1] // 2
+        return preds[..., :channels], {'std': preds[..., channels:]}
@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+
+def _worker(conn, build, compile_args, path, seed_type, batch_size, transformer, threads):
+    # workers run on the CPU; this has to be set before the first session initialises CUDA
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import tensorflow as tf
+    from data import AugmentGenerator, FoldDataset
+    from keras import backend as K
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                   inter_op_parallelism_threads=2)))
+
+    cls, input_size, params = build
+    model = cls(input_size, **params)
+    model.compile(**compile_args)
+
+    inputs = np.load(os.path.join(path, 'inputs.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+    context = None
+    if os.path.exists(os.path.join(path, 'context.npy')):
+        context = np.load(os.path.join(path, 'context.npy'))
+    shard = conn.recv()
+    dataset = FoldDataset.from_arrays([], [], [], inputs, labels)
+    generator = AugmentGenerator(None, batch_size=batch_size, seed_type=seed_type, dataset=dataset, index=shard,
+                                 context=context)
+    generator.image_transformer = transformer
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        weights, steps = message
+        model.model.set_weights(weights)
+        times, results, samples = [], [], 0
+        for _ in range(steps):
+            x, y = next(generator)
+            start = time.time()
+            results.append(np.array(model.trainer.train_on_batch(x, y), ndmin=1) * len(x))
+            times.append(time.time() - start)
+            samples += len(x)
+        conn.send((model.model.get_weights(), np.sum(results, axis=0), samples, times))
+    conn.close()
+
+
+def _schedule(steps, workers, sync_every):
+    # steps per worker in each round; an epoch trains len(generator) batches in all
+    local = min(sync_every, -(-steps // workers))
+    rounds = []
+    while steps > 0:
+        n = min(steps, workers * local)
+        rounds.append([n // workers + (rank < n % workers) for rank in range(workers)])
+        steps -= n
+    return rounds
+
+
+def train_parallel(model, generator, val_gen, epochs, workers, sync_every=10, initial_epoch=0):
+    """Local data-parallel training by periodic weight averaging.
+
+    Each worker process trains its own copy on a shard of `generator` for up
+    to `sync_every` steps; the copies are then averaged and redistributed. An
+    epoch is len(generator) steps across all workers.
+    """
+    if not hasattr(generator, 'image_transformer') or generator.y is None:
+        raise ValueError('Data-parallel training needs an AugmentGenerator with labels.')
+    if model.trainer is not model.model or not hasattr(model, 'compile_args'):
+        raise ValueError('Data-parallel training needs a model compiled without distillation.')
+    from keras.callbacks import History
+
+    path = tempfile.mkdtemp(prefix='parallel_')
+    index = np.asarray(generator.index)
+    # only the rows being trained on are written, in generator order
+    np.save(os.path.join(path, 'inputs.npy'), generator.x[index])
+    np.save(os.path.join(path, 'labels.npy'), generator.y[index])
+    if generator.context is not None:
+        np.save(os.path.join(path, 'context.npy'), generator.context)
+    shards = np.array_split(np.random.permutation(len(index)), workers)
+
+    build = (model.__class__, model.input_size, model.params)
+    threads = max(1, multiprocessing.cpu_count() // workers)
+    ctx = multiprocessing.get_context('spawn')
+    conns, processes = [], []
+    for rank in range(workers):
+        parent, child = ctx.Pipe()
+        process = ctx.Process(target=_worker,
+                              args=(child, build, model.compile_args, path, generator.seed_type,
+                                    generator.batch_size, generator.image_transformer, threads))
+        process.start()
+        parent.send(np.sort(shards[rank]))
+        conns.append(parent)
+        processes.append(process)
+
+    rounds = _schedule(len(generator), workers, sync_every)
+    weights = model.model.get_weights()
+    history = History()
+    history.history = {}
+    try:
+        for epoch in range(initial_epoch, epochs):
+            start = time.time()
+            totals, samples, step_times = 0., 0, [[] for _ in range(workers)]
+            for counts in rounds:
+                # workers left without steps in a trimmed last round sit it out
+                active = [rank for rank in range(workers) if counts[rank]]
+                for rank in active:
+                    conns[rank].send((weights, counts[rank]))
+                replies = [conns[rank].recv() for rank in active]
+                weights = [np.mean(ws, axis=0) for ws in zip(*[r[0] for r in replies])]
+                for rank, (_, result, n, times) in zip(active, replies):
+                    totals = totals + result
+                    samples += n
+                    step_times[rank].extend(times)
+            model.model.set_weights(weights)
+
+            elapsed = time.time() - start
+            logs = dict(zip(model.model.metrics_names, np.array(totals, ndmin=1) / samples))
+            if val_gen is not None:
+                values = np.array(model.model.evaluate_generator(val_gen), ndmin=1)
+                logs.update({'val_' + name: value for name, value in zip(model.model.metrics_names, values)})
+            for k, v in logs.items():
+                history.history.setdefault(k, []).append(float(v))
+            logging.info('epoch {}/{}: {:.1f}s, {:.2f} volumes/s, step time per worker {} {}'.format(
+                epoch + 1, epochs, elapsed, samples / elapsed,
+                ['{:.3f}s'.format(np.mean(t)) if t else '-' for t in step_times],
+                {k: float(v) for k, v in logs.items()}))
+    finally:
+        for conn, process in zip(conns, processes):
+            # a worker that died must not hide the error that brought us here
+            try:
+                conn.send(None)
+            except (BrokenPipeError, EOFError, OSError):
+                process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(path)
+    return history
@@ -0,0 +1,104 @@
+import glob
+import logging
+import multiprocessing
+import numpy as np
+import os
+import scipy.ndimage as ndi
+import time
+import util
+from analysis import series_time
+logging.basicConfig(level=logging.INFO)
+
+from argparse import ArgumentParser
+parser = ArgumentParser()
+parser.add_argument('input',
+                    metavar='PREDICT_PATH',
+                    help='Directory of predicted masks, {series}_{time}.nii.gz',
+                    type=str)
+parser.add_argument('output',
+                    metavar='SAVE_PATH',
+                    help='Where the cleaned masks are written',
+                    type=str)
+parser.add_argument('--median',
+                    metavar='FRAMES',
+                    help='Majority filter over this many time points (odd, 1 to disable)',
+                    dest='median', type=int, default=5)
+parser.add_argument('--opening',
+                    metavar='ITERATIONS',
+                    help='Binary opening iterations per frame (0 to disable)',
+                    dest='opening', type=int, default=1)
+parser.add_argument('--chunk',
+                    metavar='FRAMES',
+                    help='Time points processed at once per series',
+                    dest='chunk', type=int, default=32)
+parser.add_argument('--processes',
+                    metavar='PROCESSES',
+                    help='Series processed in parallel',
+                    dest='processes', type=int)
+
+# 3D connectivity within a frame, nothing across time points
+FRAME_STRUCTURE = np.zeros((3, 3, 3, 3), dtype=bool)
+FRAME_STRUCTURE[1] = ndi.generate_binary_structure(3, 1)
+
+
+def largest_component(masks):
+    # one labelling call for all frames; labels are numbered frame by frame
+    labels, _ = ndi.label(masks, structure=FRAME_STRUCTURE)
+    sizes = np.bincount(labels.ravel())
+    last = np.maximum.accumulate(labels.reshape(len(labels), -1).max(axis=1))
+    keep = np.zeros(len(sizes), dtype=bool)
+    start = 1
+    for stop in last + 1:
+        if stop > start:
+            keep[start + np.argmax(sizes[start:stop])] = True
+        start = max(start, stop)
+    return keep[labels]
+
+
+def clean(masks, median=5, opening=1):
+    # masks: (time, x, y, z) booleans for consecutive time points
+    if median > 1:
+        masks = ndi.median_filter(masks.astype(np.uint8), size=(median, 1, 1, 1), mode='nearest') > 0
+    if opening:
+        masks = ndi.binary_opening(masks, structure=FRAME_STRUCTURE, iterations=opening)
+    masks = largest_component(masks)
+    return ndi.binary_fill_holes(masks, structure=FRAME_STRUCTURE)
+
+
+def series_files(path):
+    series = {}
+    for filename in glob.glob(os.path.join(path, '*.nii.gz')):
+        name, t = series_time(filename)
+        series.setdefault(name, []).append((t, filename))
+    return {name: [f for _, f in sorted(files)] for name, files in series.items()}
+
+
+def process_series(args):
+    files, output, median, opening, chunk = args
+    start = time.time()
+    # blocks overlap by the filter's half width so every written frame saw its full window
+    pad = median // 2
+    for lo in range(0, len(files), chunk):
+        hi = min(lo + chunk, len(files))
+        read_lo, read_hi = max(0, lo - pad), min(len(files), hi + pad)
+        masks = np.stack([util.read_vol(f)[..., 0] >= 0.5 for f in files[read_lo:read_hi]])
+        masks = clean(masks, median=median, opening=opening)
+        for i in range(lo, hi):
+            util.save_vol(masks[i - read_lo].astype(np.float32), os.path.join(output, os.path.basename(files[i])),
+                          util.header(files[i]))
+    return len(files), time.time() - start
+
+
+def main(options):
+    os.makedirs(options.output, exist_ok=True)
+    series = series_files(options.input)
+    tasks = [(files, options.output, options.median, options.opening, options.chunk) for files in series.values()]
+    start = time.time()
+    with multiprocessing.Pool(options.processes) as pool:
+        for name, (frames, seconds) in zip(series, pool.imap(process_series, tasks)):
+            logging.info('{}: {} time points in {:.1f}s'.format(name, frames, seconds))
+    logging.info('total time: {}s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
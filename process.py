@@ -1,29 +1,84 @@
 import constants
 import glob
 import numpy as np
+import scipy.ndimage as ndi
 from util import read_vol
 
 
-def crop(vol):
-    if (vol.shape[0] < constants.TARGET_SHAPE[0] or
-        vol.shape[1] < constants.TARGET_SHAPE[1] or
-        vol.shape[2] < constants.TARGET_SHAPE[2]):
+def crop_offset(shape):
+    return tuple(abs(shape[i] - constants.TARGET_SHAPE[i]) // 2 for i in range(3))
+
+
+def crop(vol, offset=None, size=None):
+    # a TARGET_SHAPE window unless size is given; channels are kept as they are
+    size = tuple(constants.TARGET_SHAPE[:3]) if size is None else tuple(size)
+    if (vol.shape[0] < size[0] or
+        vol.shape[1] < size[1] or
+        vol.shape[2] < size[2]):
         raise ValueError('The input shape {shape} is not supported.'.format(shape=vol.shape))
 
     # convert to target shape
-    dx = abs(constants.TARGET_SHAPE[0] - vol.shape[0]) // 2
-    dy = abs(constants.TARGET_SHAPE[1] - vol.shape[1]) // 2
-    dz = abs(constants.TARGET_SHAPE[2] - vol.shape[2]) // 2
-    
-    resized = vol[dx:-dx, dy:-dy, dz:-dz]
-    if resized.shape != constants.TARGET_SHAPE:
+    dx, dy, dz = crop_offset(vol.shape) if offset is None else offset
+
+    resized = vol[dx:dx + size[0],
+                  dy:dy + size[1],
+                  dz:dz + size[2]]
+    if resized.shape[:3] != size:
         raise ValueError('The resized shape {shape} '
                          'does not match the target '
                          'shape {target}'.format(shape=resized.shape,
-                                                 target=constants.TARGET_SHAPE))
+                                                 target=size))
     return resized
 
 
+def roi_offset(shape, centre):
+    # top corner of a target-sized window around centre, kept inside the volume
+    offset = np.round(np.asarray(centre) - np.array(constants.TARGET_SHAPE[:3]) / 2)
+    offset = np.clip(offset, 0, np.array(shape[:3]) - np.array(constants.TARGET_SHAPE[:3]))
+    return tuple(int(o) for o in offset)
+
+
+def roi_window(shape, lo, hi, multiple, size=None):
+    # [lo, hi) grown to a multiple of the UNet downsampling (or to size) and kept inside the volume
+    shape = np.array(shape[:3])
+    if size is None:
+        size = -(-(hi - lo) // multiple) * multiple
+    size = np.minimum(size, shape // multiple * multiple)
+    lo = np.clip(lo - (size - (hi - lo)) // 2, 0, shape - size)
+    return lo, size
+
+
+def roi_windows(shapes, bounds, multiple):
+    # one size for the whole batch, so the windows stack; capped by the smallest volume
+    cap = np.min([np.array(shape[:3]) // multiple * multiple for shape in shapes], axis=0)
+    size = np.max([roi_window(shape, lo, hi, multiple)[1] for shape, (lo, hi) in zip(shapes, bounds)], axis=0)
+    size = np.minimum(size, cap)
+    windows = []
+    for shape, (lo, hi) in zip(shapes, bounds):
+        lo, window = roi_window(shape, lo, hi, multiple, size)
+        windows.append((tuple(int(o) for o in lo), tuple(int(s) for s in window)))
+    return windows
+
+
+def roi_bounds(changed, margin, multiple):
+    # network window around the changed voxels, padded by margin and grown to a multiple
+    # of the UNet downsampling; the merged region stays margin // 2 inside the window
+    shape = np.array(changed.shape)
+    idx = np.argwhere(changed)
+    lo, size = roi_window(shape, idx.min(axis=0) - margin, idx.max(axis=0) + 1 + margin, multiple)
+    hi = lo + size
+    merge_lo = np.where(lo > 0, lo + margin // 2, 0)
+    merge_hi = np.where(hi < shape, hi - margin // 2, shape)
+    window = tuple(slice(int(a), int(b)) for a, b in zip(lo, hi))
+    merge = tuple(slice(int(a), int(b)) for a, b in zip(merge_lo, merge_hi))
+    return window, merge
+
+
+def downsample(vol, shape=constants.COARSE_SHAPE):
+    factors = np.array(shape[:3]) / np.array(vol.shape[:3])
+    return np.stack([ndi.zoom(vol[..., c], factors, order=1) for c in range(vol.shape[-1])], axis=-1)
+
+
 def scale(vol):
     return vol / constants.MAX_VALUE
 
@@ -31,6 +86,7 @@ def scale(vol):
 PRE_FUNCTIONS = {
     'resize': crop,
     'rescale': scale,
+    'coarse': downsample,
 }
 
 
@@ -41,23 +97,23 @@ def preprocess(file, funcs=['rescale', 'resize']):
     return vol
 
 
-def uncrop(vol, shape):
-    if vol.shape != constants.TARGET_SHAPE:
+def uncrop(vol, shape, offset=None):
+    # the centre crop is TARGET_SHAPE; windows pasted at an offset can be any size that fits
+    if offset is None and vol.shape[:3] != constants.TARGET_SHAPE[:3]:
         raise ValueError('The input shape {shape} is not supported.'.format(shape=vol.shape))
-    if (shape[0] < constants.TARGET_SHAPE[0] or
-        shape[1] < constants.TARGET_SHAPE[1] or
-        shape[2] < constants.TARGET_SHAPE[2]):
+    if (shape[0] < vol.shape[0] or
+        shape[1] < vol.shape[1] or
+        shape[2] < vol.shape[2]):
         raise ValueError('The target shape {shape} is not supported.'.format(shape=shape))
 
-    # convert to original shape
-    dx = abs(shape[0] - constants.TARGET_SHAPE[0]) // 2
-    dy = abs(shape[1] - constants.TARGET_SHAPE[1]) // 2
-    dz = abs(shape[2] - constants.TARGET_SHAPE[2]) // 2
+    # paste back into the original shape
+    dx, dy, dz = crop_offset(shape) if offset is None else offset
 
-    resized = np.pad(vol, ((dx, dx), (dy, dy), (dz, dz), (0, 0)), 'constant')
-    if resized.shape != shape:
-        raise ValueError('The resized shape {shape} '
-                         'does not match the target '
-                         'shape {target}'.format(shape=resized.shape,
-                                                 target=shape))
+    if dx + vol.shape[0] > shape[0] or dy + vol.shape[1] > shape[1] or dz + vol.shape[2] > shape[2]:
+        raise ValueError('A {shape} window at {offset} does not fit the target '
+                         'shape {target}'.format(shape=vol.shape, offset=(dx, dy, dz), target=shape))
+    resized = np.zeros(tuple(shape[:3]) + vol.shape[3:], dtype=vol.dtype)
+    resized[dx:dx + vol.shape[0],
+            dy:dy + vol.shape[1],
+            dz:dz + vol.shape[2]] = vol
     return resized
@@ -0,0 +1,122 @@
+import constants
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from models import UNETS, unet
+from util import atomic_write_json
+
+# built models by weights file, so repeated loads in one process skip graph construction
+_models = {}
+
+
+def final_metrics(history):
+    return {k: float(v[-1]) for k, v in history.history.items() if v}
+
+
+class Registry:
+    """Index of trained models in {path}/registry.json.
+
+    Each entry points at a weights-only file (no optimiser state) and records
+    everything needed to rebuild the network and its inputs.
+    """
+
+    def __init__(self, path='models', filename='registry.json'):
+        self.path = path
+        self.filename = os.path.join(path, filename)
+        self.entries = self._read()
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename) as f:
+            return json.load(f)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # concurrent runs (sweeps, parallel folds) register into the same file
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.filename + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save(self):
+        atomic_write_json(self.entries, self.filename)
+
+    def register(self, model, seed_type=None, concat=False, funcs=('rescale', 'resize'), metrics=None,
+                 checkpoint=None):
+        sizes = {cls: size for size, cls in UNETS.items()}
+        if model.__class__ not in sizes:
+            raise ValueError('Only UNet models can be registered, not {}.'.format(model.__class__.__name__))
+        created = datetime.now()
+        weights_file = os.path.join(self.path, '{}.{}.weights.h5'.format(model.name,
+                                                                        created.strftime('%m.%d.%y-%H:%M:%S')))
+        model.model.save_weights(weights_file)
+        entry = {
+            'name': model.name,
+            'created': created.isoformat(),
+            'weights': weights_file,
+            'checkpoint': checkpoint,
+            'size': sizes[model.__class__],
+            'params': model.params,
+            'input_size': list(model.input_size),
+            'seed_type': seed_type,
+            'concat': bool(concat),
+            'funcs': list(funcs),
+            'target_shape': list(constants.TARGET_SHAPE),
+            'max_value': constants.MAX_VALUE,
+            'metrics': metrics or {},
+        }
+        with self._locked():
+            # entries other runs added since this registry was opened are kept
+            self.entries = self._read()
+            self.entries.append(entry)
+            self.save()
+        return entry
+
+    def find(self, name, which='latest', metric='val_dice_coef'):
+        entries = [e for e in self.entries if e['name'] == name]
+        if not entries:
+            raise ValueError('No registered model named {}.'.format(name))
+        if which == 'latest':
+            return max(entries, key=lambda e: e['created'])
+        if which == 'best':
+            scored = [e for e in entries if metric in e['metrics']]
+            if not scored:
+                raise ValueError('No {} model has a {} score.'.format(name, metric))
+            sign = -1 if 'loss' in metric else 1
+            return max(scored, key=lambda e: sign * e['metrics'][metric])
+        raise ValueError('Registry lookup {} not defined.'.format(which))
+
+    def find_file(self, filename):
+        # the entry whose weights or training checkpoint is filename, if any
+        path = os.path.abspath(filename)
+        for entry in sorted(self.entries, key=lambda e: e['created'], reverse=True):
+            files = [entry['weights'], entry.get('checkpoint')]
+            if any(f is not None and os.path.abspath(f) == path for f in files):
+                return entry
+        return None
+
+    def load(self, name, which='latest', metric='val_dice_coef'):
+        return self.build(self.find(name, which, metric))
+
+    def build(self, entry):
+        if (entry['target_shape'] != list(constants.TARGET_SHAPE) or
+                entry['max_value'] != constants.MAX_VALUE):
+            raise ValueError('{} was trained with target shape {} and max value {}.'.format(
+                entry['weights'], entry['target_shape'], entry['max_value']))
+        model = _models.get(entry['weights'])
+        if model is None:
+            start = time.time()
+            input_size = tuple(entry['input_size'])
+            model = unet(entry['size'], input_size, name=entry['name'], filename=entry['weights'],
+                         **entry['params'])
+            _models[entry['weights']] = model
+            logging.info('Loaded {} in {:.2f}s.'.format(entry['weights'], time.time() - start))
+        return model, entry
@@ -0,0 +1,191 @@
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+from util import atomic_write_json
+logging.basicConfig(level=logging.INFO)
+
+from argparse import ArgumentParser
+parser = ArgumentParser()
+parser.add_argument('space',
+                    metavar='SPACE_FILE',
+                    help='JSON object mapping each parameter to the values to try',
+                    type=str)
+parser.add_argument('--organ',
+                    metavar='ORGAN',
+                    help='Organ to segment',
+                    dest='organ', type=str, default='placenta')
+parser.add_argument('--trials',
+                    metavar='TRIALS',
+                    help='Number of configurations to sample from the space (all if it is smaller)',
+                    dest='trials', type=int, default=27)
+parser.add_argument('--min-epochs',
+                    metavar='EPOCHS',
+                    help='Epochs every trial gets before the first cut',
+                    dest='min_epochs', type=int, default=10)
+parser.add_argument('--max-epochs',
+                    metavar='EPOCHS',
+                    help='Epochs the surviving trials are trained for',
+                    dest='max_epochs', type=int, default=270)
+parser.add_argument('--eta',
+                    metavar='ETA',
+                    help='Keep the best 1/ETA trials at each rung and train them ETA times longer',
+                    dest='eta', type=int, default=3)
+parser.add_argument('--processes',
+                    metavar='PROCESSES',
+                    help='Trials trained at the same time',
+                    dest='processes', type=int, default=2)
+parser.add_argument('--batch-size',
+                    metavar='BATCH_SIZE',
+                    help='Training batch size',
+                    dest='batch_size', type=int, default=1)
+parser.add_argument('--val-fraction',
+                    metavar='FRACTION',
+                    help='Fraction of subjects held out to score trials',
+                    dest='val_fraction', type=float, default=0.2)
+parser.add_argument('--path',
+                    metavar='PATH',
+                    help='Where trial results and weights are cached',
+                    dest='path', type=str, default='sweeps')
+parser.add_argument('--data-root',
+                    metavar='PATH',
+                    help='Directory holding {kind}/{sample}/ volumes',
+                    dest='data_root', type=str, default='data')
+
+# parameters of UNet.compile and AugmentGenerator; 'size' picks the UNet variant
+LOSS_PARAMS = ('boundary_weight', 'pool')
+AUGMENT_PARAMS = ('rotation_range', 'shift_range', 'shear_range', 'zoom_range')
+SPACE = ('size',) + LOSS_PARAMS + AUGMENT_PARAMS
+
+# per-process state, loaded once by the pool initialiser
+_trial = {}
+
+
+def sample_configs(space, n, seed=0):
+    for key in space:
+        if key not in SPACE:
+            raise ValueError('Sweep parameter {} not defined.'.format(key))
+    keys = sorted(space)
+    grid = list(itertools.product(*(space[k] for k in keys)))
+    if n < len(grid):
+        grid = [grid[i] for i in sorted(np.random.RandomState(seed).choice(len(grid), n, replace=False))]
+    return [dict(zip(keys, values)) for values in grid]
+
+
+def trial_key(config, options):
+    spec = {'config': config, 'organ': options.organ, 'batch_size': options.batch_size,
+            'val_fraction': options.val_fraction}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _init_trial(root, organ, val_fraction):
+    from catalog import Catalog
+    from data import FoldDataset
+
+    inputs, labels, samples = Catalog(root).pairs(organ)
+    dataset = FoldDataset(inputs, labels, samples)
+    groups = sorted(set(samples))
+    held_out = max(1, int(round(val_fraction * len(groups))))
+    val_groups = np.random.RandomState(0).permutation(groups)[:held_out]
+    val = np.isin(dataset.groups, val_groups)
+    _trial['dataset'] = dataset
+    _trial['train'], _trial['val'] = np.flatnonzero(~val), np.flatnonzero(val)
+
+
+def _run_trial(args):
+    key, config, epochs, trained, path, batch_size = args
+    import constants
+    import util
+    from callbacks import volume_dice
+    from data import AugmentGenerator, VolumeGenerator
+    from keras import backend as K
+    from models import unet
+
+    dataset, train, val = _trial['dataset'], _trial['train'], _trial['val']
+    checkpoint = os.path.join(path, key + '.h5')
+    start = time.time()
+    model = unet(config.get('size'), constants.TARGET_SHAPE, name=key,
+                 filename=checkpoint if trained else None)
+    model.compile(util.get_weights(dataset.labels[train]),
+                  **{k: config[k] for k in LOSS_PARAMS if k in config})
+    generator = AugmentGenerator(None, batch_size=batch_size, dataset=dataset, index=train,
+                                 **{k: config[k] for k in AUGMENT_PARAMS if k in config})
+    model.train(generator, None, epochs, initial_epoch=trained)
+    model.model.save_weights(checkpoint)
+
+    val_gen = VolumeGenerator(dataset.input_files,
+                              label_files=dataset.label_files,
+                              batch_size=batch_size,
+                              include_labels=True,
+                              dataset=dataset,
+                              index=val)
+    dice = float(np.mean(np.concatenate([volume_dice(y, model.model.predict_on_batch(x)) for x, y in val_gen])))
+    K.clear_session()
+    return key, epochs, dice, time.time() - start
+
+
+def load_results(path):
+    filename = os.path.join(path, 'results.json')
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    atomic_write_json(results, os.path.join(path, 'results.json'))
+
+
+def main(options):
+    with open(options.space) as f:
+        space = json.load(f)
+    os.makedirs(options.path, exist_ok=True)
+    results = load_results(options.path)
+
+    configs = {}
+    for config in sample_configs(space, options.trials):
+        key = trial_key(config, options)
+        configs[key] = config
+        results.setdefault(key, {'config': config, 'dice': {}, 'trained': 0})
+
+    pool = multiprocessing.get_context('spawn').Pool(options.processes, initializer=_init_trial,
+                                                     initargs=(options.data_root, options.organ,
+                                                               options.val_fraction))
+    active = sorted(configs)
+    epochs = min(options.min_epochs, options.max_epochs)
+    total = 0.
+    while True:
+        # results are cached per (trial, epochs); an interrupted sweep picks up where it stopped
+        tasks = [(key, configs[key], epochs, results[key]['trained'], options.path, options.batch_size)
+                 for key in active if str(epochs) not in results[key]['dice']]
+        if any(task[3] > epochs for task in tasks):
+            raise ValueError('Cached weights were trained past {} epochs; clear {}.'.format(epochs, options.path))
+        logging.info('Rung at {} epochs: {} trials, {} cached.'.format(epochs, len(active), len(active) - len(tasks)))
+        for key, trained, dice, seconds in pool.imap_unordered(_run_trial, tasks):
+            results[key]['dice'][str(trained)] = dice
+            results[key]['trained'] = trained
+            total += seconds
+            save_results(options.path, results)
+            logging.info('{} {}: dice {:.4f} after {} epochs ({:.0f}s)'.format(key, configs[key], dice, trained,
+                                                                              seconds))
+
+        active.sort(key=lambda k: results[k]['dice'][str(epochs)], reverse=True)
+        if epochs >= options.max_epochs or len(active) == 1:
+            break
+        active = active[:max(1, len(active) // options.eta)]
+        epochs = min(epochs * options.eta, options.max_epochs)
+
+    pool.close()
+    pool.join()
+    best = active[0]
+    logging.info('Best: {} {} with dice {:.4f} after {} epochs.'.format(best, configs[best],
+                                                                      results[best]['dice'][str(epochs)], epochs))
+    logging.info('Training time this sweep: {:.0f}s'.format(total))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
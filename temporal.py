@@ -0,0 +1,54 @@
+import csv
+import numpy as np
+import os
+from analysis import series_time
+
+
+class ChangeDetector:
+    def __init__(self, threshold, path, stride=4, log='skip_log.csv'):
+        self.threshold = threshold
+        self.stride = stride
+        self.reference = None
+        self.reference_file = None
+        self.series = None
+        self.last_pred = None
+        self.source = -1
+        filename = os.path.join(path, log)
+        new = not os.path.exists(filename)
+        self.log = open(filename, 'a', newline='')
+        self.writer = csv.writer(self.log)
+        if new:
+            self.writer.writerow(['file', 'reference', 'score', 'skipped'])
+
+    def score(self, small):
+        return float(np.mean(np.abs(small - self.reference)))
+
+    def plan(self, batch, files):
+        # decide from the inputs alone which frames need a forward pass; the rest
+        # reuse the mask of the last inferred frame of the same series
+        need, sources = [], []
+        self.source = -1
+        for i, fname in enumerate(files):
+            small = batch[i, ::self.stride, ::self.stride, ::self.stride, :1]
+            series = series_time(fname)[0]
+            score = np.nan
+            if self.reference is not None and series == self.series:
+                score = self.score(small)
+            skipped = score <= self.threshold
+            if not skipped:
+                need.append(i)
+                self.source = len(need) - 1
+                self.reference, self.reference_file, self.series = small, fname, series
+            sources.append(self.source)
+            self.writer.writerow([fname, self.reference_file, score, int(skipped)])
+        self.log.flush()
+        return need, sources
+
+    def assemble(self, preds, sources):
+        combined = np.array([preds[s] if s >= 0 else self.last_pred for s in sources])
+        if self.source >= 0:
+            self.last_pred = preds[self.source]
+        return combined
+
+    def close(self):
+        self.log.close()
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+
+from analysis import SeriesTable, measure, series_time
+
+
+def test_series_time():
+    assert series_time('out/a_b_12.nii.gz') == ('a_b', 12)
+
+
+def test_measure():
+    preds = np.zeros((2, 4, 4, 4, 1))
+    preds[0, 1:3, 0, 0] = .9
+    volumes = np.arange(2 * 64, dtype=float).reshape(2, 4, 4, 4, 1)
+    table = measure(preds, volumes, offsets=(10, 0, 0), voxel_volumes=2.)
+    assert list(table['voxels']) == [2, 0]
+    assert table['volume'][0] == 4.
+    assert table['mean'][0] == (volumes[0, 1, 0, 0, 0] + volumes[0, 2, 0, 0, 0]) / 2
+    assert table['centroid_x'][0] == 11.5
+    # empty masks have no statistics
+    assert np.isnan(table['mean'][1]) and np.isnan(table['p50'][1])
+
+
+def test_series_table(tmp_path):
+    path = str(tmp_path)
+    table = SeriesTable(path)
+    names = table.append(['s_2.nii.gz', 's_1.nii.gz'], {'voxels': [5, 3], 'volume': [10, 6]})
+    assert names == {'s'}
+    table.append(['s_2.nii.gz'], {'voxels': [7], 'volume': [14]})
+    assert table.has('s_1.nii.gz') and not table.has('s_3.nii.gz')
+    table.save(names)
+
+    loaded = SeriesTable(path)
+    assert os.path.exists(os.path.join(path, 's_measures.csv'))
+    columns = loaded.array('s')
+    assert list(columns['time']) == [1, 2]
+    assert list(columns['voxels']) == [3, 7]
@@ -0,0 +1,73 @@
+import glob
+import os
+
+import pytest
+
+from catalog import Catalog, parse
+
+
+def touch(root, *parts):
+    path = os.path.join(str(root), *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+    return path
+
+
+def test_parse():
+    assert parse('data/raw/a/a_12.nii.gz') == ('a', 12, None)
+    assert parse('a_3_placenta.nii.gz') == ('a', 3, 'placenta')
+    assert parse('a_x.nii.gz') is None
+    assert parse('a_3.nii') is None
+
+
+def test_glob_and_pairs(tmp_path):
+    for t in (10, 2):
+        touch(tmp_path, 'raw', 'a', 'a_{}.nii.gz'.format(t))
+        touch(tmp_path, 'labels', 'a', 'a_{}_placenta.nii.gz'.format(t))
+    touch(tmp_path, 'raw', 'b', 'b_1.nii.gz')
+    touch(tmp_path, 'raw', 'a', 'notes.txt')
+    catalog = Catalog(str(tmp_path))
+
+    # numeric time order, and * does not cross directories
+    raw = catalog.glob(os.path.join(str(tmp_path), 'raw', '*', '*.nii.gz'))
+    assert [os.path.basename(f) for f in raw] == ['a_2.nii.gz', 'a_10.nii.gz', 'b_1.nii.gz']
+    assert catalog.glob(os.path.join(str(tmp_path), '*.nii.gz')) == []
+
+    inputs, labels, samples = catalog.pairs('placenta')
+    assert [os.path.basename(f) for f in inputs] == ['a_2.nii.gz', 'a_10.nii.gz']
+    assert samples == ['a', 'a']
+    catalog.check_pairs(inputs, labels)
+    with pytest.raises(ValueError):
+        catalog.partner(raw[2], 'labels', 'placenta')
+
+
+def test_rescans_changed_directories(tmp_path):
+    touch(tmp_path, 'raw', 'a', 'a_1.nii.gz')
+    assert Catalog(str(tmp_path)).find('raw', 'a', 1) is not None
+    assert os.path.exists(os.path.join(str(tmp_path), '.catalog.json'))
+    touch(tmp_path, 'raw', 'c', 'c_1.nii.gz')
+    catalog = Catalog(str(tmp_path))
+    assert catalog.find('raw', 'c', 1) == os.path.join(str(tmp_path), 'raw', 'c', 'c_1.nii.gz')
+
+
+def test_glob_outside_root(tmp_path):
+    touch(tmp_path, 'other', 'x_2.nii.gz')
+    touch(tmp_path, 'other', 'x_1.nii.gz')
+    os.makedirs(os.path.join(str(tmp_path), 'data'))
+    catalog = Catalog(os.path.join(str(tmp_path), 'data'))
+    found = catalog.glob(os.path.join(str(tmp_path), 'other', '*.nii.gz'))
+    assert [os.path.basename(f) for f in found] == ['x_1.nii.gz', 'x_2.nii.gz']
+
+
+def test_glob_agrees_with_disk(tmp_path):
+    touch(tmp_path, 'raw', 'a', 'a_1.nii.gz')
+    touch(tmp_path, 'raw', 'a', 'scan.nii.gz')
+    touch(tmp_path, 'raw', 'a', '.a_2.nii.gz')
+    touch(tmp_path, 'raw', 'loose.nii.gz')
+    touch(tmp_path, 'predict', 'a', 'placenta-0', 'a_1.nii.gz')
+    touch(tmp_path, 'predict', 'a', 'placenta-0', 'a_2.nii.gz')
+    catalog = Catalog(str(tmp_path))
+    for pattern in ['raw/*/*.nii.gz', 'raw/a/*', 'raw/*', '*/*/*', 'predict/*/*/*.nii.gz', 'predict/a/*',
+                    'raw/a/.*', 'labels/*/*.nii.gz']:
+        pattern = os.path.join(str(tmp_path), *pattern.split('/'))
+        assert sorted(catalog.glob(pattern)) == sorted(glob.glob(pattern)), pattern
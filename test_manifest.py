@@ -0,0 +1,20 @@
+import os
+
+from manifest import Manifest
+
+
+def test_manifest(tmp_path):
+    path = str(tmp_path)
+    record = {'inputs': ['abc'], 'weights': 'def', 'config': {}}
+    manifest = Manifest(path)
+    manifest.update('a_1.nii.gz', record)
+    # the output itself has to exist
+    assert not manifest.is_current('a_1.nii.gz', record)
+    open(os.path.join(path, 'a_1.nii.gz'), 'w').close()
+    assert manifest.is_current('a_1.nii.gz', record)
+    manifest.save()
+
+    loaded = Manifest(path)
+    assert loaded.is_current('a_1.nii.gz', record)
+    assert not loaded.is_current('a_1.nii.gz', dict(record, weights='xyz'))
+    assert not os.path.exists(loaded.filename + '.tmp')
@@ -0,0 +1,49 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from keras import backend as K
+from keras import layers
+from keras.models import Model
+
+import constants
+import util
+from data import VolumeGenerator
+from models import BaseModel, Ensemble, predict_models
+
+
+class Constant(BaseModel):
+    def __init__(self, value):
+        self.value = value
+        super().__init__(constants.TARGET_SHAPE)
+
+    def _new_model(self):
+        inputs = layers.Input(self.input_size)
+        outputs = layers.Lambda(lambda x: K.zeros_like(x) + self.value)(inputs)
+        self.model = Model(inputs=inputs, outputs=outputs)
+
+
+def test_ensemble_predictions(tmp_path):
+    files = []
+    for i in range(2):
+        files.append(str(tmp_path / 'vol_{}.nii.gz'.format(i)))
+        util.save_vol(np.random.randint(0, 100, (100, 100, 70)).astype(np.float32), files[-1])
+    path = str(tmp_path / 'predict')
+    os.makedirs(path)
+
+    ensemble = Ensemble([Constant(.6), Constant(1.)])
+    predict_models([ensemble], VolumeGenerator(files), [path], resume=False)
+
+    for f in files:
+        name = os.path.basename(f)
+        mask = np.asanyarray(nib.load(os.path.join(path, name)).dataobj)
+        std = nib.load(os.path.join(path, 'std', name))
+        assert mask.shape[:3] == std.shape[:3] == (100, 100, 70)
+        assert std.get_data_dtype() == np.float32
+        # the mean rounds to a mask; the disagreement keeps its fraction
+        assert mask.max() == 1 and mask.sum() == np.prod(constants.TARGET_SHAPE)
+        assert np.isclose(np.asanyarray(std.dataobj).max(), .2)
@@ -0,0 +1,11 @@
+from parallel import _schedule
+
+
+def test_schedule_covers_one_epoch():
+    assert _schedule(9, 2, 10) == [[5, 4]]
+    assert _schedule(45, 2, 10) == [[10, 10], [10, 10], [3, 2]]
+    assert _schedule(1, 4, 10) == [[1, 0, 0, 0]]
+    for steps in range(1, 50):
+        rounds = _schedule(steps, 3, 4)
+        assert sum(map(sum, rounds)) == steps
+        assert all(max(counts) <= 4 for counts in rounds)
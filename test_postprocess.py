@@ -0,0 +1,35 @@
+import numpy as np
+
+from postprocess import clean, largest_component
+
+
+def test_largest_component_per_frame():
+    masks = np.zeros((2, 8, 8, 8), dtype=bool)
+    masks[0, :3, :3, :3] = True
+    masks[0, 6, 6, 6] = True
+    masks[1, 5:, 5:, 5:] = True
+    masks[1, 0, 0, 0] = True
+    kept = largest_component(masks)
+    assert kept[0].sum() == 27 and not kept[0, 6, 6, 6]
+    assert kept[1].sum() == 27 and not kept[1, 0, 0, 0]
+
+
+def test_largest_component_empty_frame():
+    masks = np.zeros((3, 4, 4, 4), dtype=bool)
+    masks[2, 1, 1, 1] = True
+    kept = largest_component(masks)
+    assert kept[:2].sum() == 0 and kept[2, 1, 1, 1]
+
+
+def test_clean():
+    masks = np.zeros((5, 10, 10, 10), dtype=bool)
+    masks[:, 2:8, 2:8, 2:8] = True
+    masks[:, 4, 4, 4] = False
+    # a single frame dropout and a speck
+    masks[2] = False
+    masks[1, 0, 0, 0] = True
+    cleaned = clean(masks, median=3, opening=0)
+    assert np.array_equal(cleaned[2], cleaned[0])
+    assert not cleaned[1, 0, 0, 0]
+    # holes are filled
+    assert cleaned[:, 4, 4, 4].all()
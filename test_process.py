@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import constants
+from process import crop, crop_offset, roi_bounds, roi_window, roi_windows, uncrop
+
+
+def test_roi_window_multiple():
+    lo, size = roi_window((100, 100, 70), np.array([10, 10, 10]), np.array([20, 30, 11]), 16)
+    assert list(size) == [16, 32, 16]
+    assert np.all(lo >= 0) and np.all(lo + size <= [100, 100, 70])
+
+
+def test_roi_window_capped_at_volume():
+    lo, size = roi_window((40, 40, 40), np.array([0, 0, 0]), np.array([40, 40, 40]), 16)
+    assert list(size) == [32, 32, 32]
+    assert list(lo) == [4, 4, 4]
+
+
+def test_roi_windows_stack_across_shapes():
+    shapes = [(96, 96, 64), (96, 96, 48)]
+    bounds = [(np.array([0, 0, 0]), np.array([90, 90, 60])), (np.array([10, 10, 10]), np.array([20, 20, 20]))]
+    windows = roi_windows(shapes, bounds, 16)
+    assert windows[0][1] == windows[1][1] == (96, 96, 48)
+    for shape, (lo, size) in zip(shapes, windows):
+        assert all(o >= 0 and o + s <= d for o, s, d in zip(lo, size, shape))
+    np.stack([np.zeros(shape)[tuple(slice(o, o + s) for o, s in zip(lo, size))]
+              for shape, (lo, size) in zip(shapes, windows)])
+
+
+def test_roi_bounds():
+    changed = np.zeros((96, 96, 64), dtype=bool)
+    changed[40:44, 50, 0] = True
+    window, merge = roi_bounds(changed, 8, 16)
+    for w, m in zip(window, merge):
+        assert (w.stop - w.start) % 16 == 0
+        assert w.start <= m.start < m.stop <= w.stop
+    # the edit is inside the merged region
+    assert changed[merge].sum() == changed.sum()
+    # clipped at the volume edge, the merge reaches it too
+    assert window[2].start == merge[2].start == 0
+
+
+def test_crop_uncrop_round_trip():
+    shape = (100, 100, 70)
+    vol = np.random.rand(*shape + (2,))
+    cropped = crop(vol)
+    assert cropped.shape == constants.TARGET_SHAPE[:3] + (2,)
+    restored = uncrop(cropped, shape)
+    dx, dy, dz = crop_offset(shape)
+    assert restored.shape == shape + (2,)
+    assert np.array_equal(restored[dx:dx + 96, dy:dy + 96, dz:dz + 64], cropped)
+    assert restored[:dx].sum() == 0
+
+
+def test_uncrop_window():
+    window = np.ones((32, 32, 16, 1))
+    restored = uncrop(window, (100, 100, 70), (60, 0, 54))
+    assert restored.sum() == window.sum()
+    with pytest.raises(ValueError):
+        uncrop(window, (100, 100, 70), (70, 0, 0))
+    with pytest.raises(ValueError):
+        uncrop(window, (100, 100, 70))
@@ -0,0 +1,36 @@
+import csv
+import os
+
+import numpy as np
+
+from temporal import ChangeDetector
+
+
+def test_reference_across_batches_and_series(tmp_path):
+    detector = ChangeDetector(.1, str(tmp_path), stride=1)
+    vol = np.zeros((2, 4, 4, 4, 1))
+    preds = np.arange(2, dtype=float).reshape(2, 1)
+
+    need, sources = detector.plan(vol, ['s_1.nii.gz', 's_2.nii.gz'])
+    assert need == [0] and sources == [0, 0]
+    assert list(detector.assemble(preds[need], sources)) == [0, 0]
+
+    # the reference carries over into the next batch, which then needs no forward pass
+    need, sources = detector.plan(vol[:1], ['s_3.nii.gz'])
+    assert need == [] and sources == [-1]
+    assert list(detector.assemble(None, sources)) == [0]
+
+    # a new series starts its own reference, even with identical inputs
+    changed = vol.copy()
+    changed[1] += 1
+    need, sources = detector.plan(changed, ['t_1.nii.gz', 't_2.nii.gz'])
+    assert need == [0, 1] and sources == [0, 1]
+    assert list(detector.assemble(preds + 5, sources)) == [5, 6]
+    detector.close()
+
+    with open(os.path.join(str(tmp_path), 'skip_log.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['file'] for row in rows] == ['s_1.nii.gz', 's_2.nii.gz', 's_3.nii.gz', 't_1.nii.gz', 't_2.nii.gz']
+    assert [row['skipped'] for row in rows] == ['0', '1', '1', '0', '0']
+    assert [row['reference'] for row in rows] == ['s_1.nii.gz'] * 3 + ['t_1.nii.gz', 't_2.nii.gz']
+    assert rows[0]['score'] == 'nan' and rows[3]['score'] == 'nan' and float(rows[4]['score']) == 1.
@@ -0,0 +1,18 @@
+import pytest
+
+from util import validation_split
+
+
+def test_validation_split():
+    items = list('abcdefghij')
+    train, val = validation_split(items, .2)
+    assert len(val) == 2 and sorted(train + val) == items
+    assert validation_split(items, .2) == (train, val)
+    assert validation_split(items, 0) == (items, items)
+
+
+def test_validation_split_keeps_both_sides():
+    assert [len(part) for part in validation_split(['a', 'b'], .9)] == [1, 1]
+    assert [len(part) for part in validation_split(['a', 'b', 'c'], .01)] == [2, 1]
+    with pytest.raises(ValueError):
+        validation_split(['a'], .2)
@@ -0,0 +1,248 @@
+import constants
+import glob
+import hashlib
+import json
+import math
+import numpy as np
+import os
+import tensorflow as tf
+from keras import backend as K
+from keras.utils.data_utils import Sequence
+from process import preprocess
+from util import atomic_write_json, file_hash
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def records_key(input_files, label_files, concat_files=None):
+    # everything the records are derived from, so changed sources or preprocessing rewrite them
+    spec = {
+        'inputs': [file_hash(f) for f in input_files],
+        'labels': [file_hash(f) for f in label_files],
+        'concat': None if concat_files is None else [file_hash(f) for f in concat_files],
+        'target_shape': list(constants.TARGET_SHAPE),
+        'max_value': constants.MAX_VALUE,
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def records_current(path, key):
+    return os.path.exists(os.path.join(path, 'meta.json')) and read_meta(path).get('key') == key
+
+
+def write_records(path, input_files, label_files, concat_files=None, shards=8, key=None):
+    os.makedirs(path, exist_ok=True)
+    for filename in glob.glob(os.path.join(path, '*.tfrecord')) + glob.glob(os.path.join(path, 'meta.json')):
+        os.remove(filename)
+    if key is None:
+        key = records_key(input_files, label_files, concat_files)
+    concat = None
+    if concat_files is not None:
+        concat = np.concatenate((preprocess(concat_files[0]),
+                                 preprocess(concat_files[1], funcs=['resize'])), axis=-1)
+
+    shards = min(shards, len(input_files))
+    writers = [tf.io.TFRecordWriter(os.path.join(path, 'shard-{:05d}-of-{:05d}.tfrecord'.format(i, shards)))
+               for i in range(shards)]
+    label_sum, label_size = 0., 0
+    for i, (input_file, label_file) in enumerate(zip(input_files, label_files)):
+        x = preprocess(input_file)
+        if concat is not None:
+            x = np.concatenate((x, concat), axis=-1)
+        x = x.astype(np.float32)
+        y = preprocess(label_file, funcs=['resize']).astype(np.float32)
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'x': _bytes_feature(x.tobytes()),
+            'y': _bytes_feature(y.tobytes()),
+        }))
+        writers[i % shards].write(example.SerializeToString())
+        label_sum += float(y.sum())
+        label_size += y.size
+    for writer in writers:
+        writer.close()
+
+    meta = {
+        'n': len(input_files),
+        'x_shape': list(x.shape),
+        'y_shape': list(y.shape),
+        'label_mean': label_sum / label_size,
+        'key': key,
+    }
+    # written last, so an interrupted write is never taken as current
+    atomic_write_json(meta, os.path.join(path, 'meta.json'))
+    return meta
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def _parse(record, x_shape, y_shape):
+    features = tf.io.parse_single_example(record, {
+        'x': tf.io.FixedLenFeature([], tf.string),
+        'y': tf.io.FixedLenFeature([], tf.string),
+    })
+    x = tf.reshape(tf.io.decode_raw(features['x'], tf.float32), x_shape)
+    y = tf.reshape(tf.io.decode_raw(features['y'], tf.float32), y_shape)
+    return x, y
+
+
+def _matrix(rows):
+    return tf.stack([tf.stack(row) for row in rows])
+
+
+def _interpolate(vol, coords):
+    # trilinear sampling with coordinates clamped to the volume, matching
+    # scipy's affine_transform(order=1, mode='nearest')
+    shape = vol.shape.as_list()
+    flat = tf.reshape(vol, [-1, shape[-1]])
+    maxes = np.array(shape[:3], dtype=np.float32) - 1
+    coords = tf.clip_by_value(coords, 0., maxes)
+    lower = tf.floor(coords)
+    frac = coords - lower
+    lower = tf.cast(lower, tf.int32)
+    upper = tf.minimum(lower + 1, maxes.astype(np.int32))
+
+    outputs = 0.
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                corner = [upper[:, a] if d else lower[:, a] for a, d in enumerate((dx, dy, dz))]
+                weight = 1.
+                for a, d in enumerate((dx, dy, dz)):
+                    weight *= frac[:, a] if d else 1. - frac[:, a]
+                idx = corner[0] * shape[1] * shape[2] + corner[1] * shape[2] + corner[2]
+                outputs += tf.gather(flat, idx) * weight[:, tf.newaxis]
+    return tf.reshape(outputs, shape)
+
+
+def random_transform(x, y,
+                     rotation_range=90.,
+                     shift_range=0.1,
+                     shear_range=0.1,
+                     zoom_range=0.1,
+                     flip=True):
+    """In-graph counterpart of `ImageTransformer.random_transform`.
+
+    Draws the same rotation, shift, shear and zoom ranges and composes them
+    in the same order, then applies the warp to `x` and `y` together.
+    """
+    shape = x.shape.as_list()[:3]
+    channels = x.shape.as_list()[-1]
+    xy = tf.concat([x, y], axis=-1)
+    one, zero = tf.constant(1.), tf.constant(0.)
+
+    transform = tf.eye(4)
+    if rotation_range:
+        rx, ry, rz = tf.unstack(tf.random.uniform([3], -rotation_range, rotation_range) * np.pi / 180)
+        Rx = _matrix([[one, zero, zero, zero],
+                      [zero, tf.cos(rx), -tf.sin(rx), zero],
+                      [zero, tf.sin(rx), tf.cos(rx), zero],
+                      [zero, zero, zero, one]])
+        Ry = _matrix([[tf.cos(ry), zero, tf.sin(ry), zero],
+                      [zero, one, zero, zero],
+                      [-tf.sin(ry), zero, tf.cos(ry), zero],
+                      [zero, zero, zero, one]])
+        Rz = _matrix([[tf.cos(rz), -tf.sin(rz), zero, zero],
+                      [tf.sin(rz), tf.cos(rz), zero, zero],
+                      [zero, zero, one, zero],
+                      [zero, zero, zero, one]])
+        transform = tf.matmul(transform, tf.matmul(tf.matmul(Rx, Ry), Rz))
+
+    if shift_range:
+        t = tf.random.uniform([3], -shift_range, shift_range)
+        if shift_range < 1:
+            t *= np.array(shape, dtype=np.float32)
+        tx, ty, tz = tf.unstack(t)
+        transform = tf.matmul(transform, _matrix([[one, zero, zero, tx],
+                                                  [zero, one, zero, ty],
+                                                  [zero, zero, one, tz],
+                                                  [zero, zero, zero, one]]))
+
+    if shear_range:
+        sxy, sxz, syx, syz, szx, szy = tf.unstack(tf.random.uniform([6], -shear_range, shear_range))
+        transform = tf.matmul(transform, _matrix([[one, sxy, sxz, zero],
+                                                  [syx, one, syz, zero],
+                                                  [szx, szy, one, zero],
+                                                  [zero, zero, zero, one]]))
+
+    if np.isscalar(zoom_range):
+        zoom_range = [1 - zoom_range, 1 + zoom_range]
+    if zoom_range[0] != 1 or zoom_range[1] != 1:
+        zoom = tf.random.uniform([3], zoom_range[0], zoom_range[1])
+        transform = tf.matmul(transform, tf.linalg.diag(tf.concat([zoom, [1.]], axis=0)))
+
+    offset = np.eye(4, dtype=np.float32)
+    offset[:3, 3] = np.array(shape, dtype=np.float32) / 2 + 0.5
+    reset = np.eye(4, dtype=np.float32)
+    reset[:3, 3] = -offset[:3, 3]
+    transform = tf.matmul(tf.matmul(offset, transform), reset)
+
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing='ij'), axis=-1)
+    grid = grid.reshape(-1, 3).astype(np.float32)
+    coords = tf.matmul(grid, transform[:3, :3], transpose_b=True) + transform[:3, 3]
+    xy = _interpolate(xy, coords)
+
+    if flip:
+        for axis in range(3):
+            xy = tf.cond(tf.random.uniform([]) < 0.5,
+                         lambda: tf.reverse(xy, [axis]),
+                         lambda: xy)
+
+    return xy[..., :channels], xy[..., channels:]
+
+
+def add_seed(x, y, seed_type):
+    label = y[..., :1]
+    if seed_type == 'slice':
+        rows = tf.where(tf.reduce_any(label > 0, axis=[1, 2, 3]))[:, 0]
+        r = tf.gather(rows, tf.random.uniform([], 0, tf.shape(rows)[0], dtype=tf.int32))
+        mask = tf.reshape(tf.one_hot(r, tf.shape(label)[0]), [-1, 1, 1, 1])
+        seed = label * mask
+    elif seed_type == 'volume':
+        seed = label
+    else:
+        raise ValueError('Seed type {} not defined.'.format(seed_type))
+    return tf.concat([x, seed], axis=-1), y
+
+
+def make_dataset(path, batch_size=1, seed_type=None, augment=True, shuffle=64, **transform_kwargs):
+    meta = read_meta(path)
+    files = tf.data.Dataset.list_files(os.path.join(path, '*.tfrecord'), shuffle=True)
+    dataset = files.interleave(tf.data.TFRecordDataset,
+                               cycle_length=min(len(os.listdir(path)) - 1, 8),
+                               num_parallel_calls=AUTOTUNE)
+    dataset = dataset.shuffle(shuffle).repeat()
+    dataset = dataset.map(lambda record: _parse(record, meta['x_shape'], meta['y_shape']),
+                          num_parallel_calls=AUTOTUNE)
+    if augment:
+        dataset = dataset.map(lambda x, y: random_transform(x, y, **transform_kwargs),
+                              num_parallel_calls=AUTOTUNE)
+    if seed_type is not None:
+        dataset = dataset.map(lambda x, y: add_seed(x, y, seed_type), num_parallel_calls=AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+
+class TFDataGenerator(Sequence):
+    def __init__(self, path, batch_size=1, seed_type=None, augment=True, **transform_kwargs):
+        meta = read_meta(path)
+        self.n = meta['n']
+        self.batch_size = batch_size
+        self.weights = (1 - meta['label_mean'], meta['label_mean'])
+        dataset = make_dataset(path, batch_size, seed_type, augment, **transform_kwargs)
+        self.next_batch = dataset.make_one_shot_iterator().get_next()
+        self.session = K.get_session()
+
+    def __len__(self):
+        return math.ceil(self.n / self.batch_size)
+
+    def __getitem__(self, idx):
+        # the pipeline is an endless shuffled stream, so the index is ignored. Keras 2.2's fit_generator
+        # only takes numpy batches, so each batch is copied out of the session once; decoding and
+        # augmentation still run in parallel inside the graph, ahead of the training step.
+        return self.session.run(self.next_batch)
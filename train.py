@@ -48,28 +48,416 @@ parser.add_argument('--size',
                     metavar='SIZE',
                     help='Size of UNet',
                     dest='size', type=str)
+parser.add_argument('--block',
+                    metavar='BLOCK',
+                    help='UNet convolution block (conv, factorised or separable)',
+                    dest='block', type=str)
+parser.add_argument('--norm',
+                    metavar='NORM',
+                    help='UNet normalisation (batch or instance)',
+                    dest='norm', type=str)
+parser.add_argument('--depth',
+                    metavar='DEPTH',
+                    help='Number of UNet pooling levels',
+                    dest='depth', type=int)
+parser.add_argument('--filters',
+                    metavar='FILTERS',
+                    help='Filters in the first UNet level',
+                    dest='filters', type=int)
+parser.add_argument('--profile',
+                    help='Report parameters, FLOPs and latency of every UNet variant',
+                    dest='profile', action='store_true')
+parser.add_argument('--checkpoint',
+                    metavar='BLOCKS',
+                    help='Recompute these UNet blocks in the backward pass (encoder, all or comma-separated names)',
+                    dest='checkpoint', type=str)
+parser.add_argument('--profile-training',
+                    help='Report training step time and peak memory of every UNet variant with and without '
+                         'activation checkpointing',
+                    dest='profile_training', action='store_true')
+parser.add_argument('--export',
+                    metavar='EXPORT_FILE',
+                    help='Export an inference model (.tflite or .h5)',
+                    dest='export', type=str)
+parser.add_argument('--prune',
+                    metavar='SPARSITY',
+                    help='Fraction of convolution weights to zero on export (stored dense: smaller '
+                         'compressed files, no speedup)',
+                    dest='prune', type=float)
+parser.add_argument('--calibrate',
+                    metavar='INPUT_FILES, [SEED_FILES/LABEL_FILES]',
+                    help='Volumes to calibrate int8 quantisation on export',
+                    dest='calibrate', type=str, nargs='+')
+parser.add_argument('--distill',
+                    metavar='MODE',
+                    help='Distil the model given by --model-file into a new model (online or cached)',
+                    dest='distill', type=str)
+parser.add_argument('--teacher-size',
+                    metavar='SIZE',
+                    help='Size of the teacher UNet',
+                    dest='teacher_size', type=str)
+parser.add_argument('--alpha',
+                    metavar='ALPHA',
+                    help='Weight of the ground truth loss when distilling',
+                    dest='alpha', type=float, default=0.5)
+parser.add_argument('--records',
+                    metavar='RECORDS_PATH',
+                    help='Train from sharded TFRecords with a tf.data pipeline (rewritten when the sources change)',
+                    dest='records', type=str)
+parser.add_argument('--bank',
+                    metavar='VARIANTS',
+                    help='Precompute this many augmented variants per volume and sample from them',
+                    dest='bank', type=int)
+parser.add_argument('--bank-refresh',
+                    metavar='FRACTION',
+                    help='Fraction of the augmentation bank recomputed each epoch',
+                    dest='bank_refresh', type=float, default=0.)
+parser.add_argument('--bank-path',
+                    metavar='BANK_PATH',
+                    help='Directory for the memory-mapped augmentation bank',
+                    dest='bank_path', type=str)
+parser.add_argument('--val-every',
+                    metavar='EPOCHS',
+                    help='Validate every this many epochs',
+                    dest='val_every', type=int, default=1)
+parser.add_argument('--val-samples',
+                    metavar='SAMPLES',
+                    help='Validate on a fixed random sample of this many volumes',
+                    dest='val_samples', type=int)
+parser.add_argument('--val-split',
+                    metavar='FRACTION',
+                    help='Hold out this fraction of the training volumes for validation',
+                    dest='val_split', type=float)
+parser.add_argument('--val-dice',
+                    help='Validate with a streaming dice over cached batches instead of evaluate',
+                    dest='val_dice', action='store_true')
+parser.add_argument('--autotune',
+                    help='Pick the batch size with the best training throughput',
+                    dest='autotune', action='store_true')
+parser.add_argument('--memory-budget',
+                    metavar='GB',
+                    help='Peak memory allowed when autotuning the batch size',
+                    dest='memory_budget', type=float)
+parser.add_argument('--accumulate',
+                    metavar='STEPS',
+                    help='Accumulate gradients over this many batches per update',
+                    dest='accumulate', type=int, default=1)
+parser.add_argument('--effective-batch-size',
+                    metavar='BATCH_SIZE',
+                    help='Accumulate gradients until this many volumes per update',
+                    dest='effective_batch_size', type=int)
+parser.add_argument('--localizer',
+                    help='Train a low resolution localiser for cascade segmentation',
+                    dest='localizer', action='store_true')
+parser.add_argument('--cascade',
+                    metavar='LOCALIZER_FILE',
+                    help='Segment a window around the organ found by this localiser; sized to the organ '
+                         'for UNet models, else a re-centred TARGET_SHAPE crop',
+                    dest='cascade', type=str)
+parser.add_argument('--skip-threshold',
+                    metavar='THRESHOLD',
+                    help='Reuse the previous mask when a frame changes less than this (mean abs. intensity)',
+                    dest='skip_threshold', type=float)
+parser.add_argument('--incremental',
+                    help='After seed/label edits, re-segment only a window around the edited voxels',
+                    dest='incremental', action='store_true')
+parser.add_argument('--extra-model',
+                    metavar='MODEL_FILE|MODEL_NAME, SAVE_PATH',
+                    help='Also predict with this model from the same decoded inputs (repeatable); registered '
+                         'models are built from their own entry and must take the same seed and concat',
+                    dest='extra_models', type=str, nargs=2, action='append', default=[])
+parser.add_argument('--workers',
+                    metavar='WORKERS',
+                    help='Train data-parallel in this many local CPU processes',
+                    dest='workers', type=int, default=1)
+parser.add_argument('--prefetch',
+                    metavar='BATCHES',
+                    help='Decode this many batches ahead in a thread pool when predicting and testing',
+                    dest='prefetch', type=int, default=0)
+parser.add_argument('--prefetch-memory',
+                    metavar='MB',
+                    help='Cap on the memory held by prefetched batches',
+                    dest='prefetch_memory', type=float)
+parser.add_argument('--sync-every',
+                    metavar='STEPS',
+                    help='Average the worker weights after this many steps each',
+                    dest='sync_every', type=int, default=10)
+parser.add_argument('--load',
+                    metavar='MODEL_NAME [latest|best]',
+                    help='Load a registered model instead of --model-file',
+                    dest='load', type=str, nargs='+')
+parser.add_argument('--ensemble',
+                    metavar='MODEL_NAME',
+                    help='Predict and test with the mean of these registered models, e.g. the one-out folds',
+                    dest='ensemble', type=str, nargs='+')
+parser.add_argument('--data-root',
+                    metavar='PATH',
+                    help='Directory holding {kind}/{sample}/ volumes, indexed once into a catalog',
+                    dest='data_root', type=str, default='data')
 parser.add_argument('--gpu',
                     metavar='GPU',
                     help='Which GPU to use',
                     dest='gpu', type=str, nargs=1)
+parser.add_argument('--overwrite',
+                    help='Regenerate predictions that are already up to date',
+                    dest='overwrite', action='store_true')
+parser.add_argument('--measure',
+                    help='Record organ volume, intensity and centroid per time point while predicting',
+                    dest='measure', action='store_true')
 parser.add_argument('--run',
                     metavar='RUN',
                     help='Which preset program to run',
                     dest='run', type=str)
+parser.add_argument('--curriculum',
+                    metavar='FACTOR:EPOCHS',
+                    help='Train the first epochs on volumes downsampled by these factors, in order (with --run)',
+                    dest='curriculum', type=str, nargs='+')
+parser.add_argument('--population',
+                    metavar='PATTERN',
+                    help='Checkpoints the fine-tune preset starts from ({} is the held-out sample)',
+                    dest='population', type=str, default='models/unet_brains_one-out_{}_weights.*.h5')
+parser.add_argument('--freeze-encoder',
+                    help='Only train the decoder when fine-tuning',
+                    dest='freeze_encoder', action='store_true')
+parser.add_argument('--patience',
+                    metavar='EPOCHS',
+                    help='Stop fine-tuning after this many epochs without a better validation dice',
+                    dest='patience', type=int, default=10)
+parser.add_argument('--target-dice',
+                    metavar='DICE',
+                    help='Report the time taken to reach this validation dice',
+                    dest='target_dice', type=float, default=0.8)
 options = parser.parse_args()
 
 os.environ['CUDA_VISIBLE_DEVICES'] = options.gpu[0]
 
 import constants
 import glob
+import multiprocessing
+import numpy as np
 import time
 import util
-from data import AugmentGenerator, VolumeGenerator
-from models import UNet, UNetSmall, UNetBig
+from callbacks import StagedEarlyStopping, TimeToTarget
+from catalog import Catalog
+from cascade import CascadeGenerator, roi_dataset
+from compress import QuantizedModel, compare, export
+from data import AugmentBank, AugmentGenerator, FoldDataset, VolumeGenerator, add_seeds
+from keras import backend as K
+from models import BLOCKS, UNETS, Ensemble, UNet, predict_models, training_profile, unet
+from registry import Registry, final_metrics
+from tfdata import TFDataGenerator, records_current, records_key, write_records
+
+
+def checkpoint_param(value):
+    if value is None or value in ('all', 'encoder'):
+        return value
+    return value.split(',')
+
+
+def unet_params(options):
+    params = {'block': options.block, 'norm': options.norm, 'depth': options.depth, 'filters': options.filters,
+              'checkpoint': checkpoint_param(options.checkpoint)}
+    return {k: v for k, v in params.items() if v is not None}
+
+
+def profile(options, shape):
+    for size in UNETS:
+        for block in BLOCKS:
+            params = dict(unet_params(options), block=block)
+            stats = unet(size, shape, **params).profile(batch_size=options.batch_size)
+            logging.info('{:<8} {:<12} params: {:>10}  GFLOPs: {:8.2f}  latency: {:.3f}s'.format(
+                size, block, stats['params'], stats['flops'] / 1e9, stats['latency']))
+            K.clear_session()
+
+
+def profile_training(options, shape):
+    ctx = multiprocessing.get_context('spawn')
+    for size in UNETS:
+        for checkpoint in (None, 'encoder', 'all'):
+            params = dict(unet_params(options), checkpoint=checkpoint)
+            # one process per variant: peak memory never goes down within a process
+            with ctx.Pool(1) as pool:
+                stats = pool.apply(training_profile, (size, shape), dict(params, batch_size=options.batch_size))
+            logging.info('{:<8} checkpoint {:<8} step: {:.3f}s  peak memory: {:.2f} GB'.format(
+                size, str(checkpoint), stats['step_time'], stats['peak_memory'] / 2 ** 30))
+
+
+def augment_generator(options, input_files, label_files, concat_files, dataset=None, index=None,
+                      funcs=('rescale', 'resize')):
+    if options.bank:
+        return AugmentBank(input_files,
+                           label_files,
+                           batch_size=options.batch_size,
+                           seed_type=options.seed,
+                           concat_files=concat_files,
+                           variants=options.bank,
+                           refresh=options.bank_refresh,
+                           path=options.bank_path,
+                           dataset=dataset,
+                           index=index,
+                           funcs=funcs)
+    return AugmentGenerator(input_files,
+                            label_files=label_files,
+                            batch_size=options.batch_size,
+                            seed_type=options.seed,
+                            concat_files=concat_files,
+                            dataset=dataset,
+                            index=index,
+                            funcs=funcs)
+
+
+def prefetch_kwargs(options):
+    memory_cap = None if options.prefetch_memory is None else int(options.prefetch_memory * 2 ** 20)
+    return {'prefetch': options.prefetch, 'memory_cap': memory_cap}
+
+
+def volume_generator(localizer, *args, depth=None, **kwargs):
+    if localizer is not None:
+        return CascadeGenerator(localizer, *args, depth=depth, **kwargs)
+    return VolumeGenerator(*args, **kwargs)
+
+
+def check_entry(entry, options, funcs):
+    # a registered model has to take the inputs the shared generator produces
+    if entry['seed_type'] != options.seed or entry['concat'] != bool(options.concat):
+        raise ValueError('{} takes seed {} and concat {}.'.format(entry['name'], entry['seed_type'],
+                                                                entry['concat']))
+    if list(entry['funcs']) != list(funcs):
+        raise ValueError('{} was trained on {} inputs, not {}.'.format(entry['name'], entry['funcs'], funcs))
+
+
+def extra_model(options, registry, model_file, shape, funcs):
+    if model_file.endswith('.tflite'):
+        return QuantizedModel(model_file)
+    if not os.path.exists(model_file):
+        model, entry = registry.load(model_file)
+        check_entry(entry, options, funcs)
+        return model
+    entry = registry.find_file(model_file)
+    if entry is None:
+        logging.warning('{} is not registered; building it with this run\'s size, parameters and inputs.'.format(
+            model_file))
+        return unet(options.size, shape, filename=model_file, **unet_params(options))
+    check_entry(entry, options, funcs)
+    return registry.build(entry)[0]
+
+
+def fully_convolutional(model):
+    if not isinstance(model, UNet) or None in tuple(model.input_size)[:3]:
+        return model
+    # same weights on an input of any size
+    fine = model.__class__((None, None, None) + tuple(model.input_size)[3:], name=model.name, **model.params)
+    fine.model.set_weights(model.model.get_weights())
+    if hasattr(model, 'compile_args'):
+        fine.compile(**model.compile_args)
+    return fine
+
+
+def cascade_models(localizer, models):
+    # the fine stage runs on windows sized to the organ when every model takes any input size;
+    # otherwise the cascade only re-centres the TARGET_SHAPE crop
+    if localizer is None:
+        return models, None
+    models = [fully_convolutional(m) for m in models]
+    if any(None not in tuple(m.input_size)[:3] for m in models):
+        return models, None
+    return models, max(m.params['depth'] for m in models)
+
+
+def load_localizer(options):
+    if not options.cascade:
+        return None
+    return unet('tiny', constants.COARSE_SHAPE, name='localizer', filename=options.cascade)
+
+
+def population_checkpoint(pattern, sample):
+    files = glob.glob(pattern.format(sample))
+    if not files:
+        raise ValueError('No population checkpoint matches {}.'.format(pattern.format(sample)))
+    return max(files, key=os.path.getmtime)
+
+
+def curriculum(options, depth):
+    # (factor, epochs) stages; full resolution gets whatever epochs remain
+    stages = []
+    for stage in options.curriculum or []:
+        factor, epochs = (int(v) for v in stage.split(':'))
+        for s in constants.TARGET_SHAPE[:3]:
+            if s % factor or (s // factor) % 2 ** depth:
+                raise ValueError('Downsampling {} by {} does not fit a depth {} UNet.'.format(
+                    constants.TARGET_SHAPE[:3], factor, depth))
+        stages.append((factor, epochs))
+    remaining = options.epochs - sum(epochs for _, epochs in stages)
+    if remaining > 0:
+        stages.append((1, remaining))
+    return stages
+
+
+def matching(catalog, pattern):
+    files = catalog.glob(pattern)
+    if not files:
+        raise ValueError('No volumes match {}.'.format(pattern))
+    return files
+
+
+def paired_files(catalog, input_pattern, other_pattern=None):
+    input_files = matching(catalog, input_pattern)
+    if other_pattern is None:
+        return input_files, None
+    other_files = matching(catalog, other_pattern)
+    catalog.check_pairs(input_files, other_files)
+    return input_files, other_files
+
+
+def input_partners(catalog, input_pattern, label_pattern, label_files):
+    if catalog.inside(input_pattern) and catalog.inside(label_pattern):
+        input_kind = catalog.kind(input_pattern)
+        return [catalog.partner(label_file, input_kind) for label_file in label_files]
+    # outside the catalogued tree: swap the fixed prefixes of the two patterns
+    input_path, label_path = input_pattern.split('*')[0], label_pattern.split('*')[0]
+    return [label_file.replace(label_path, input_path) for label_file in label_files]
+
+
+def test_files(catalog, patterns, gen_seed):
+    input_files, extra_files = paired_files(catalog, *patterns[:2])
+    if gen_seed:
+        return input_files, None, extra_files
+    _, label_files = paired_files(catalog, patterns[0], patterns[2])
+    return input_files, extra_files, label_files
+
+
+def train_kwargs(options):
+    kwargs = {'val_every': options.val_every, 'val_samples': options.val_samples, 'streaming': options.val_dice}
+    if options.workers > 1:
+        kwargs.update(workers=options.workers, sync_every=options.sync_every)
+    return kwargs
+
+
+def autotune(options, model):
+    logging.info('Autotuning batch size.')
+    model.compile(None)
+    budget = options.memory_budget * 2 ** 30 if options.memory_budget else None
+    options.batch_size = model.autotune(memory_budget=budget)
+    if options.effective_batch_size:
+        options.accumulate = max(1, -(-options.effective_batch_size // options.batch_size))
+    logging.info('batch size {}, accumulating {} batches'.format(options.batch_size, options.accumulate))
+
+
+def teacher_targets(teacher, generator, seed_type, batch_size):
+    inputs = generator.inputs
+    if generator.concat is not None:
+        context = np.broadcast_to(generator.concat, inputs.shape[:1] + generator.concat.shape)
+        inputs = np.concatenate((inputs, context), axis=-1)
+    if seed_type is not None:
+        inputs = add_seeds(inputs, generator.labels, seed_type)
+    return teacher.model.predict(inputs, batch_size=batch_size)
 
 
 def main(options):
     start = time.time()
+    if options.curriculum:
+        # the stages resample the decoded dataset, which only the preset programs keep in memory
+        parser.error('--curriculum needs a preset program (--run).')
 
     logging.info('Creating model.')
     shape = constants.TARGET_SHAPE
@@ -77,77 +465,195 @@ def main(options):
         shape = tuple(list(shape[:-1]) + [shape[-1] + 1])
     if options.concat:
         shape = tuple(list(shape[:-1]) + [shape[-1] + 2])
-    if options.size == 'small':
-        m = UNetSmall
-    elif options.size == 'big':
-        m = UNetBig
+    if options.profile:
+        profile(options, shape)
+        return
+    if options.incremental and options.predict and not options.train:
+        # windows around edits need a fully convolutional graph; the weights are the same
+        shape = (None, None, None) + shape[3:]
+    if options.profile_training:
+        profile_training(options, shape)
+        return
+    funcs = ['rescale', 'resize']
+    if options.localizer:
+        if options.seed or options.concat:
+            raise ValueError('The localiser only takes the raw volume.')
+        shape = constants.COARSE_SHAPE
+        funcs = ['rescale', 'coarse']
+    localizer = load_localizer(options)
+    registry = Registry()
+    teacher = None
+    if options.ensemble:
+        if options.train:
+            raise ValueError('An ensemble is built from trained models, not trained itself.')
+        members = []
+        for name in options.ensemble:
+            member, entry = registry.load(name)
+            # the members share one generator, preprocessed as the first was trained
+            funcs = funcs if members else list(entry['funcs'])
+            check_entry(entry, options, funcs)
+            members.append(member)
+        model = Ensemble(members, name=options.name)
+    elif options.load:
+        model, entry = registry.load(*options.load)
+        funcs = list(entry['funcs'])
+        check_entry(entry, options, funcs)
+    elif options.distill:
+        if options.distill not in ('online', 'cached'):
+            raise ValueError('Distillation mode {} not defined.'.format(options.distill))
+        teacher = unet(options.teacher_size, shape, name='teacher', filename=options.model_file)
+        model = unet(options.size, shape, name=options.name, **unet_params(options))
+    elif options.model_file and options.model_file.endswith('.tflite'):
+        model = QuantizedModel(options.model_file, name=options.name)
     else:
-        m = UNet
-    model = m(shape, name=options.name, filename=options.model_file)
+        model = unet(options.size or ('tiny' if options.localizer else None), shape,
+                     name=options.name, filename=options.model_file, **unet_params(options))
 
     gen_seed = (options.seed == 'slice' or options.seed == 'volume')
+    catalog = Catalog(options.data_root)
 
     if options.train:
-        logging.info('Creating data generator.')
-
-        input_path = options.train[0].split('*')[0]
-        label_path = options.train[1].split('*')[0]
+        if options.autotune:
+            autotune(options, model)
+        elif options.effective_batch_size:
+            options.accumulate = max(1, -(-options.effective_batch_size // options.batch_size))
 
-        label_files = glob.glob(options.train[1])
-        input_files = [label_file.replace(label_path, input_path) for label_file in label_files]
+        logging.info('Creating data generator.')
 
-        aug_gen = AugmentGenerator(input_files,
-                                   label_files=label_files,
-                                   batch_size=options.batch_size,
-                                   seed_type=options.seed,
-                                   concat_files=options.concat)
-        val_gen = VolumeGenerator(input_files,
-                                  label_files=label_files,
+        label_files = matching(catalog, options.train[1])
+        label_files, val_label_files = util.validation_split(label_files, options.val_split)
+        input_files = input_partners(catalog, *options.train, label_files)
+        val_input_files = input_partners(catalog, *options.train, val_label_files)
+
+        if options.distill == 'cached' and (options.records or options.bank):
+            raise ValueError('Cached distillation targets need the default augmentation generator.')
+        if options.records:
+            key = records_key(input_files, label_files, options.concat)
+            if not records_current(options.records, key):
+                logging.info('Writing records.')
+                write_records(options.records, input_files, label_files, concat_files=options.concat, key=key)
+            aug_gen = TFDataGenerator(options.records,
+                                      batch_size=options.batch_size,
+                                      seed_type=options.seed)
+        elif localizer is not None:
+            # train the fine model on crops around each label instead of the centre crop
+            dataset = roi_dataset(input_files, label_files, np.zeros(len(input_files)))
+            aug_gen = augment_generator(options, input_files, label_files, options.concat, dataset=dataset)
+        else:
+            aug_gen = augment_generator(options, input_files, label_files, options.concat, funcs=funcs)
+        val_gen = VolumeGenerator(val_input_files,
+                                  label_files=val_label_files,
                                   batch_size=options.batch_size,
                                   seed_type=options.seed,
                                   concat_files=options.concat,
                                   load_files=True,
-                                  include_labels=True)
+                                  include_labels=True,
+                                  dataset=None if localizer is None else roi_dataset(
+                                      val_input_files, val_label_files, np.zeros(len(val_input_files))),
+                                  funcs=funcs)
 
         logging.info('Compiling model.')
-        model.compile(util.get_weights(aug_gen.labels))
+        weights = aug_gen.weights if options.records else util.get_weights(aug_gen.labels)
+        if options.distill == 'cached':
+            logging.info('Caching teacher predictions.')
+            aug_gen.add_targets(teacher_targets(teacher, aug_gen, options.seed, options.batch_size))
+            val_gen.labels = np.concatenate((val_gen.labels,
+                                             teacher_targets(teacher, val_gen, options.seed, options.batch_size)),
+                                            axis=-1)
+            model.compile(weights, alpha=options.alpha, accumulate=options.accumulate)
+        elif options.distill == 'online':
+            model.compile(weights, alpha=options.alpha, teacher=teacher, accumulate=options.accumulate)
+        else:
+            model.compile(weights, accumulate=options.accumulate)
 
         logging.info('Training model.')
-        model.train(aug_gen, val_gen, options.epochs)
-        model.save()
+        history = model.train(aug_gen, val_gen, options.epochs, **train_kwargs(options))
+        if options.bank:
+            aug_gen.close()
+        checkpoint = model.save()
+        registry.register(model, seed_type=options.seed, concat=options.concat, funcs=funcs,
+                          metrics=final_metrics(history), checkpoint=checkpoint)
+
+    if options.export:
+        logging.info('Exporting model.')
+
+        calibration = None
+        if options.calibrate:
+            input_files, extra_files = paired_files(catalog, *options.calibrate)
+            cal_gen = VolumeGenerator(input_files,
+                                      seed_files=None if gen_seed else extra_files,
+                                      label_files=extra_files if gen_seed else None,
+                                      batch_size=1,
+                                      seed_type=options.seed,
+                                      concat_files=options.concat)
+            calibration = [batch[0] for batch in cal_gen]
+        export(model, options.export, sparsity=options.prune, calibration=calibration)
+
+        if options.test:
+            input_files, seed_files, label_files = test_files(catalog, options.test, gen_seed)
+            held_out = VolumeGenerator(input_files,
+                                       seed_files=seed_files,
+                                       label_files=label_files,
+                                       batch_size=options.batch_size,
+                                       seed_type=options.seed,
+                                       concat_files=options.concat,
+                                       load_files=True,
+                                       include_labels=True)
+            if options.export.endswith('.tflite'):
+                exported = QuantizedModel(options.export)
+            else:
+                exported = unet(options.size, shape, filename=options.export, **unet_params(options))
+            compare(model, exported, held_out)
 
     if options.predict:
         logging.info('Making predictions.')
 
-        input_files = glob.glob(options.predict[0])
-        seed_files = None if gen_seed else glob.glob(options.predict[1])
-        label_files = glob.glob(options.predict[1]) if gen_seed else None
+        input_files, extra_files = paired_files(catalog, *options.predict[:2])
+        seed_files = None if gen_seed else extra_files
+        label_files = extra_files if gen_seed else None
         save_path = options.predict[2]
 
-        pred_gen = VolumeGenerator(input_files,
-                                   seed_files=seed_files,
-                                   label_files=label_files,
-                                   batch_size=options.batch_size,
-                                   seed_type=options.seed,
-                                   concat_files=options.concat,
-                                   include_labels=False)
-        model.predict(pred_gen, save_path)
+        models, paths = [model], [save_path]
+        for model_file, path in options.extra_models:
+            models.append(extra_model(options, registry, model_file, shape, funcs))
+            paths.append(path)
+        if None in tuple(model.input_size)[:3]:
+            # registered models are stored at their training size; --incremental needs them any size
+            models = [fully_convolutional(m) for m in models]
+        models, depth = cascade_models(localizer, models)
+        pred_gen = volume_generator(localizer,
+                                    input_files,
+                                    seed_files=seed_files,
+                                    label_files=label_files,
+                                    batch_size=options.batch_size,
+                                    seed_type=options.seed,
+                                    concat_files=options.concat,
+                                    include_labels=False,
+                                    funcs=funcs,
+                                    depth=depth,
+                                    **prefetch_kwargs(options))
+        predict_models(models, pred_gen, paths, resume=not options.overwrite, measures=options.measure,
+                       skip_threshold=options.skip_threshold, incremental=options.incremental)
 
     if options.test:
         logging.info('Testing model.')
 
-        input_files = glob.glob(options.test[0])
-        seed_files = None if gen_seed else glob.glob(options.test[1])
-        label_files = glob.glob(options.test[1]) if gen_seed else glob.glob(options.test[2])
-
-        test_gen = VolumeGenerator(input_files,
-                                   seed_files=seed_files,
-                                   label_files=label_files,
-                                   batch_size=options.batch_size,
-                                   seed_type=options.seed,
-                                   concat_files=options.concat,
-                                   include_labels=True)
-        metrics = model.test(test_gen)
+        input_files, seed_files, label_files = test_files(catalog, options.test, gen_seed)
+
+        (tested,), depth = cascade_models(localizer, [model])
+        test_gen = volume_generator(localizer,
+                                    input_files,
+                                    seed_files=seed_files,
+                                    label_files=label_files,
+                                    batch_size=options.batch_size,
+                                    seed_type=options.seed,
+                                    concat_files=options.concat,
+                                    include_labels=True,
+                                    funcs=funcs,
+                                    depth=depth,
+                                    **prefetch_kwargs(options))
+        metrics = tested.test(test_gen)
+        test_gen.close()
         logging.info(metrics)
 
     end = time.time()
@@ -158,101 +664,162 @@ def run(options):
     start = time.time()
 
     metrics = {}
+    times = {}
 
     organ = 'all_brains' if options.organ[0] == 'brains' else options.organ[0]
-    all_labels = glob.glob('data/labels/*/*_{}.nii.gz'.format(organ))
+    catalog = Catalog(options.data_root)
+    all_inputs, all_labels, samples = catalog.pairs(organ)
+    registry = Registry()
+
+    shape = constants.TARGET_SHAPE
+    if options.seed:
+        shape = tuple(list(shape[:-1]) + [shape[-1] + 1])
+    if options.run == 'concat':
+        shape = tuple(list(shape[:-1]) + [shape[-1] + 2])
+    if options.curriculum:
+        if options.run == 'concat':
+            raise ValueError('Curriculum training does not resample the concatenated volume.')
+        # fully convolutional, so one set of weights serves every resolution
+        shape = (None, None, None) + shape[3:]
+    if options.autotune:
+        # the same shape is trained in every fold, so tune once, before any volume is loaded: on the
+        # CPU peak memory is the process peak, and the dataset would count against the budget
+        autotune(options, unet(options.size, shape, **unet_params(options)))
+        K.clear_session()
+    elif options.effective_batch_size:
+        options.accumulate = max(1, -(-options.effective_batch_size // options.batch_size))
+
+    # every volume is decoded once; folds are index views into the same arrays
+    logging.info('Loading dataset.')
+    localizer = load_localizer(options)
+    if localizer is not None:
+        dataset = roi_dataset(all_inputs, all_labels, samples)
+    else:
+        dataset = FoldDataset(all_inputs, all_labels, samples)
 
     for sample in ['043015', '051215', '061715', '062515', '081315', '083115', '110214', '112614', '122115', '122215']:
     # for sample in ['043015', '061715']:
         logging.info(sample)
 
         logging.info('Creating model.')
-        shape = constants.TARGET_SHAPE
-        if options.seed:
-            shape = tuple(list(shape[:-1]) + [shape[-1] + 1])
-        if options.run == 'concat':
-            shape = tuple(list(shape[:-1]) + [shape[-1] + 2])
-        if options.size == 'small':
-            m = UNetSmall
-        elif options.size == 'big':
-            m = UNetBig
-        else:
-            m = UNet
-        model = m(shape, name='unet_brains_{}_{}'.format(options.run, sample), filename=options.model_file)
+        model_file = options.model_file
+        if options.run == 'fine-tune':
+            model_file = population_checkpoint(options.population, sample)
+            logging.info('Starting from {}.'.format(model_file))
+        model = unet(options.size, shape, name='unet_brains_{}_{}'.format(options.run, sample),
+                     filename=model_file, **unet_params(options))
 
         logging.info('Creating data generator.')
 
         if options.run == 'concat':
-            concat_files = ['data/raw/{}/{}_1.nii.gz'.format(sample, sample),
-                            'data/labels/{}/{}_1_{}.nii.gz'.format(sample, sample, organ)]
+            concat_files = [catalog.find('raw', sample, 1), catalog.find('labels', sample, 1, organ)]
+            if None in concat_files:
+                raise ValueError('Sample {} has no labelled first volume to concatenate.'.format(sample))
         else:
             concat_files = None
 
+        in_sample = dataset.group(sample)
+        val = None
         if options.run == 'one-out':
-            label_files = [file for file in all_labels if not os.path.basename(file).startswith(sample)]
+            train, test = dataset.fold(sample)
         elif options.run == 'single':
-            label_files = glob.glob('data/labels/{}/{}_1_{}.nii.gz'.format(sample, sample, organ))
+            first = np.array([catalog.key(dataset.label_files[i])[1] == 1 for i in in_sample], dtype=bool)
+            train, test = in_sample[first], in_sample[~first]
         elif options.run == 'concat':
-            label_files = glob.glob('data/labels/{}/{}_*_{}.nii.gz'.format(sample, sample, organ))[1:4]
+            train, test = in_sample[1:4], in_sample[4:]
+        elif options.run == 'fine-tune':
+            first = np.array([catalog.key(dataset.label_files[i])[1] == 1 for i in in_sample], dtype=bool)
+            rest = in_sample[~first]
+            # a second labelled frame drives early stopping and is kept out of the test set
+            train, val, test = in_sample[first], rest[:1], rest[1:]
         else:
             raise ValueError('Preset program not defined.')
 
-        input_files = [file.replace('labels', 'raw').replace('_{}'.format(organ), '') for file in label_files]
-        aug_gen = AugmentGenerator(input_files,
-                                   label_files=label_files,
-                                   batch_size=options.batch_size,
-                                   seed_type=options.seed,
-                                   concat_files=concat_files)
-        val_gen = VolumeGenerator(input_files,
-                                  label_files=label_files,
+        if val is None:
+            train, val = util.validation_split(list(train), options.val_split)
+        val_gen = VolumeGenerator(dataset.input_files,
+                                  label_files=dataset.label_files,
                                   batch_size=options.batch_size,
                                   seed_type=options.seed,
                                   concat_files=concat_files,
-                                  load_files=True,
-                                  include_labels=True)
+                                  include_labels=True,
+                                  dataset=dataset,
+                                  index=val)
+
+        callbacks = []
+        stopper = None
+        if options.run == 'fine-tune':
+            if options.freeze_encoder:
+                model.freeze_encoder()
+            timer = TimeToTarget(options.target_dice)
+            stopper = StagedEarlyStopping(monitor='val_dice_coef', mode='max', patience=options.patience)
+            callbacks = [stopper, timer]
 
         logging.info('Compiling model.')
-        model.compile(util.get_weights(aug_gen.labels))
+        model.compile(util.get_weights(dataset.labels[train]), accumulate=options.accumulate)
 
         logging.info('Training model.')
-        model.train(aug_gen, val_gen, options.epochs)
+        epoch = 0
+        for factor, epochs in curriculum(options, model.params['depth']):
+            if factor != 1:
+                logging.info('{} epochs at 1/{} resolution.'.format(epochs, factor))
+            aug_gen = augment_generator(options, dataset.input_files, dataset.label_files, concat_files,
+                                        dataset=dataset.resample(factor), index=train)
+            history = model.train(aug_gen, val_gen, epoch + epochs, callbacks=callbacks, initial_epoch=epoch,
+                                  **train_kwargs(options))
+            epoch += epochs
+            if options.bank:
+                aug_gen.close()
+            if stopper is not None and stopper.stopped_epoch:
+                logging.info('Stopped early after {} epochs.'.format(stopper.stopped_epoch + 1))
+                break
+        if stopper is not None:
+            stopper.restore()
+        if options.run == 'fine-tune':
+            times[sample] = timer.reached
 
         logging.info('Saving model.')
-        model.save()
+        checkpoint = model.save()
 
         logging.info('Making predictions.')
-        if options.run == 'one-out':
-            label_files = glob.glob('data/labels/{}/{}_*_{}.nii.gz'.format(sample, sample, organ))
-        elif options.run == 'single':
-            label_files = [f for f in glob.glob('data/labels/{}/{}_*_{}.nii.gz'.format(sample, sample, organ))
-                           if not os.path.basename(f).endswith('_1_{}.nii.gz'.format(organ))]
-        elif options.run == 'concat':
-            label_files = glob.glob('data/labels/{}/{}_*_{}.nii.gz'.format(sample, sample, organ))[4:]
+        (fine,), depth = cascade_models(localizer, [model])
+        if localizer is not None:
+            pred_gen = CascadeGenerator(localizer,
+                                        dataset.input_files,
+                                        label_files=dataset.label_files,
+                                        batch_size=options.batch_size,
+                                        seed_type=options.seed,
+                                        concat_files=concat_files,
+                                        include_labels=False,
+                                        index=test,
+                                        depth=depth)
         else:
-            raise ValueError('Preset program not defined.')
-
-        predict_files = [file.replace('labels', 'raw').replace('_{}'.format(organ), '') for file in label_files]
-        pred_gen = VolumeGenerator(predict_files,
-                                   label_files=label_files,
-                                   batch_size=options.batch_size,
-                                   seed_type=options.seed,
-                                   concat_files=concat_files,
-                                   include_labels=False)
+            pred_gen = VolumeGenerator(dataset.input_files,
+                                       label_files=dataset.label_files,
+                                       batch_size=options.batch_size,
+                                       seed_type=options.seed,
+                                       concat_files=concat_files,
+                                       include_labels=False,
+                                       dataset=dataset,
+                                       index=test)
         save_path = 'data/predict/{}/{}-{}/'.format(sample, options.organ[0], options.run)
         if not os.path.exists(save_path):
             os.makedirs(save_path)
-        model.predict(pred_gen, save_path)
+        fine.predict(pred_gen, save_path, resume=not options.overwrite, measures=options.measure,
+                     skip_threshold=options.skip_threshold, incremental=options.incremental)
 
         logging.info('Testing model.')
-        test_gen = VolumeGenerator(predict_files,
-                                   label_files=label_files,
-                                   batch_size=options.batch_size,
-                                   seed_type=options.seed,
-                                   concat_files=concat_files,
-                                   include_labels=True)
-        metrics[sample] = model.test(test_gen)
+        test_gen = pred_gen.subset(np.arange(pred_gen.n))
+        test_gen.include_labels = True
+        metrics[sample] = fine.test(test_gen)
+        scores = dict(final_metrics(history), **{'test_' + name: float(value) for name, value in
+                                                 zip(model.model.metrics_names, metrics[sample])})
+        registry.register(model, seed_type=options.seed, concat=concat_files is not None, metrics=scores,
+                          checkpoint=checkpoint)
 
     logging.info(metrics)
+    if times:
+        logging.info('epochs and seconds to dice {}: {}'.format(options.target_dice, times))
 
     end = time.time()
     logging.info('total time: {}s'.format(end - start))
@@ -1,6 +1,9 @@
 import constants
+import hashlib
+import json
 import nibabel as nib
 import numpy as np
+import os
 
 
 def read_vol(filename):
@@ -12,17 +15,22 @@ def read_vol(filename):
     return vol
 
 
-def save_vol(vol, filename, header=None, scale=False):
+def save_vol(vol, filename, header=None, scale=False, dtype='int16'):
     if type(vol) is np.ndarray:
         if scale:
             vol *= constants.MAX_VALUE
-        vol = np.rint(vol)
-        vol = nib.Nifti1Image(vol.astype('int16'), np.diag([3, 3, 3, 1]), header=header)
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            vol = np.rint(vol)
+        vol = nib.Nifti1Image(vol.astype(dtype), np.diag([3, 3, 3, 1]), header=header)
+        # a passed header keeps the input's integer type otherwise
+        vol.set_data_dtype(dtype)
     vol.to_filename(filename)
 
 
 def shape(filename):
-    return read_vol(filename).shape
+    # read from the header, without decoding the volume
+    vol_shape = nib.load(filename).shape
+    return vol_shape + (1,) if len(vol_shape) == 3 else vol_shape
 
 
 def header(filename):
@@ -34,3 +42,31 @@ def get_weights(vols):
         return None
     w = np.sum(vols) / vols.size
     return (1 - w, w)
+
+
+def atomic_write_json(obj, filename):
+    # write then rename so an interrupted run never leaves a truncated file; per-pid
+    # temporary names keep concurrent writers apart
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def file_hash(filename, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def validation_split(items, fraction, seed=0):
+    if not fraction:
+        return items, items
+    if len(items) < 2:
+        raise ValueError('Cannot hold out a validation split from {} training volume(s).'.format(len(items)))
+    order = np.random.RandomState(seed).permutation(len(items))
+    # at least one volume each side
+    held_out = min(max(1, int(round(fraction * len(items)))), len(items) - 1)
+    return [items[i] for i in sorted(order[held_out:])], [items[i] for i in sorted(order[:held_out])]